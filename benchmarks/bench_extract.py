@@ -0,0 +1,84 @@
+"""
+Benchmark of the article content extractors.
+
+Compares extract_text (lxml) with the original BeautifulSoup implementation
+on saved pages, e.g.
+
+    python benchmarks/bench_extract.py testfiles/*.html --repeat 20
+
+Without files, or with --synthetic, generated news-like pages are used.
+"""
+import os
+import sys
+import random
+import logging
+from argparse import ArgumentParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rssnewsbot.extractor import extract_text, extract_text_soup
+
+WORDS = "market shares stock investors quarter revenue earnings analysts growth company index trading".split()
+
+
+def synthetic_page(nb_paragraphs, seed=0):
+    """
+    news-like page: navigation, scripts, an article body, a sidebar and a footer
+    """
+    rnd = random.Random(seed)
+
+    def sentence(n):
+        return " ".join(rnd.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+    nav = "".join('<li><a href="/s{0}">{1}</a></li>'.format(i, sentence(2)) for i in range(30))
+    body = "".join("<p>{0} <span>{1}</span></p>".format(sentence(40), sentence(8)) for _ in range(nb_paragraphs))
+    side = "".join("<td>{0}</td>".format(sentence(5)) for _ in range(20))
+    scripts = "".join("<script>var x{0} = {0};</script><!-- ad slot {0} -->".format(i) for i in range(20))
+    page = ('<!DOCTYPE html><html><head><title>{0}</title><style>p {{}}</style></head><body>'
+            '<div id="nav"><ul>{1}</ul></div>{2}<div class="article">{3}</div>'
+            '<table><tr>{4}</tr></table><div class="footer"><p>{5}</p></div><footer><p>{5}</p></footer>'
+            '</body></html>').format(sentence(6), nav, scripts, body, side, sentence(100))
+    return page.encode("utf-8")
+
+
+def bench(func, pages, repeat):
+    start = default_timer()
+    for _ in range(repeat):
+        for page in pages:
+            func(page)
+    return (default_timer() - start) / (repeat * len(pages))
+
+
+def same_words(a, b):
+    return (a or "").split() == (b or "").split()
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="benchmark article content extraction")
+    ap.add_argument("files", nargs="*")
+    ap.add_argument("--repeat", type=int, default=10)
+    ap.add_argument("--synthetic", type=int, default=0, help="number of generated pages to add")
+    ap.add_argument("--paragraphs", type=int, default=40, help="paragraphs per generated page")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    pages = []
+    for fname in args.files:
+        with open(fname, "rb") as f:
+            pages.append((fname, f.read()))
+    nb_synthetic = args.synthetic or (0 if pages else 5)
+    for i in range(nb_synthetic):
+        pages.append(("synthetic-%d" % i, synthetic_page(args.paragraphs, seed=i)))
+
+    for name, page in pages:
+        if not same_words(extract_text(page), extract_text_soup(page)):
+            logging.warning("extractors disagree on %s", name)
+
+    bodies = [page for _, page in pages]
+    t_lxml = bench(extract_text, bodies, args.repeat)
+    t_soup = bench(extract_text_soup, bodies, args.repeat)
+    logging.info("%d pages, %d KB on average", len(bodies), sum(len(p) for p in bodies) / len(bodies) / 1024)
+    logging.info("extract_text_soup %8.2f ms/page", t_soup * 1000)
+    logging.info("extract_text      %8.2f ms/page", t_lxml * 1000)
+    logging.info("speedup           %8.1fx", t_soup / t_lxml)
@@ -0,0 +1,311 @@
+"""
+Offline benchmark of the feed updater and the article spider.
+
+The feeds and the news sites are replaced by a local fake server (see
+fakeserver.py). Both stages run as their own processes against local redis
+and mongodb instances and are measured through their metrics endpoints:
+
+1. feed_updater.py polls one feed per symbol of the given lists for
+   --duration seconds, filling the pending stream
+2. the article spider downloads the pending articles until the stream is
+   empty or --duration seconds have passed
+
+THE BENCHMARK WIPES redis db 0 and 1 and the rssnews database of mongodb, run
+it against throwaway instances only (the article spider connects to the
+default localhost ports). E.g.
+
+    python benchmarks/bench_pipeline.py DJI.txt NDX.txt --wipe --duration 60
+    python benchmarks/bench_pipeline.py DJI.txt --wipe --compare 1d5f052
+
+Both stages run on --python (default: the interpreter running the benchmark),
+which must be the Python 3 the tree targets; they are checked to start before
+anything is wiped.
+
+Results are saved to benchmarks/results/<git rev>.json, --compare prints the
+relative changes against a saved result (a rev or a file name).
+"""
+import os
+import re
+import sys
+import json
+import shlex
+import socket
+import logging
+import tempfile
+import subprocess
+from time import time, sleep
+from datetime import datetime
+from argparse import ArgumentParser
+from urllib.request import urlopen
+import redis
+import pymongo as pm
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeserver import FakeNewsServer, load_pages, ROOT
+
+sys.path.insert(0, ROOT)
+
+from rssnewsbot.settings import PENDING_STREAM
+
+RESULTS = os.path.join(ROOT, "benchmarks", "results")
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def scrape(port):
+    """
+    {metric name: [(labels, value)]} read from a prometheus text endpoint
+    """
+    metrics = {}
+    text = urlopen("http://127.0.0.1:{0}/metrics".format(port), timeout=5).read().decode("utf-8")
+    for line in text.splitlines():
+        m = SAMPLE.match(line)
+        if m:
+            name, labels, value = m.groups()
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', labels or ""))
+            metrics.setdefault(name, []).append((labels, float(value)))
+    return metrics
+
+
+def total(metrics, name):
+    return sum(v for _, v in metrics.get(name, []))
+
+
+def quantile(metrics, name, q):
+    """
+    quantile estimated from the buckets of a histogram, interpolated linearly within a bucket
+    """
+    buckets = {}
+    for labels, value in metrics.get(name + "_bucket", []):
+        buckets[float(labels["le"])] = buckets.get(float(labels["le"]), 0) + value
+    bounds = sorted(buckets)
+    if not bounds or buckets[bounds[-1]] == 0:
+        return None
+    rank = q * buckets[bounds[-1]]
+    lower, below = 0.0, 0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(buckets[bound] - below, 1)
+        lower, below = bound, buckets[bound]
+
+
+def peak_rss(pid):
+    """
+    peak resident memory in MB of a process and its children (linux only)
+    """
+    pids, rss = [pid], 0
+    while pids:
+        p = pids.pop()
+        try:
+            with open("/proc/{0}/status".format(p)) as f:
+                rss += int(re.search(r"VmHWM:\s+(\d+)", f.read()).group(1))
+            with open("/proc/{0}/task/{0}/children".format(p)) as f:
+                pids.extend(int(x) for x in f.read().split())
+        except (IOError, OSError, AttributeError):
+            pass
+    return rss / 1024.0 or None
+
+
+def stop(proc, timeout=30):
+    deadline = time() + timeout
+    while proc.poll() is None and time() < deadline:
+        sleep(0.2)
+    if proc.poll() is None:
+        proc.terminate()
+        proc.wait()
+
+
+def wait_for_metrics(port, proc, timeout=30):
+    deadline = time() + timeout
+    while time() < deadline and proc.poll() is None:
+        try:
+            return scrape(port)
+        except (IOError, OSError):
+            sleep(0.2)
+    raise RuntimeError("no metrics endpoint on port {0}".format(port))
+
+
+def preflight(args):
+    """
+    fail early unless both stages can start on args.python
+    """
+    for cmd in ([args.python, os.path.join(ROOT, "feed_updater.py"), "--help"],
+                [args.python, "-m", "scrapy", "list"]):
+        proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = proc.communicate()[0].decode("utf-8", "replace")
+        if proc.returncode != 0 or (cmd[-1] == "list" and "articlespider" not in out.split()):
+            raise RuntimeError("{0} cannot start:\n{1}".format(" ".join(cmd), out))
+
+
+def seed(mc, rc, df, server, fnames):
+    """
+    wipe the databases and add one feed per symbol pointing at the fake server
+    """
+    rc.flushdb()
+    df.flushdb()
+    mc.drop_database("rssnews")
+    feeds = {}
+    for fname in fnames:
+        index = os.path.splitext(os.path.basename(fname))[0]
+        with open(fname) as f:
+            for line in f:
+                if line.strip():
+                    symbol, company = line.strip().split("\t")
+                    feed = feeds.setdefault(symbol, {"symbol": symbol, "company": company, "indexes": [],
+                                                     "url": server.feed_url(symbol)})
+                    feed["indexes"].append(index)
+    mc.rssnews.feed.insert_many(list(feeds.values()))
+    return len(feeds)
+
+
+def bench_feed_updater(args, rc):
+    port = free_port()
+    cmd = [args.python, os.path.join(ROOT, "feed_updater.py"), "--mode", args.mode, "--proxy", "",
+           "--redis-host", args.redis_host, "--redis-port", str(args.redis_port), "--mongodb-uri", args.mongodb_uri,
+           "--update-interval", str(args.update_interval), "--metrics-port", str(port)] + shlex.split(args.updater_args)
+    rc.set("feed_updater", "start")
+    proc = subprocess.Popen(cmd, cwd=ROOT)
+    try:
+        wait_for_metrics(port, proc)
+        start = time()
+        sleep(args.duration)
+        metrics = scrape(port)
+        elapsed = time() - start
+        rss = peak_rss(proc.pid)
+    finally:
+        rc.set("feed_updater", "stop")
+        stop(proc)
+    feeds = total(metrics, "rssnews_feed_responses_total")
+    return {
+        "feeds": feeds,
+        "feeds_per_sec": feeds / elapsed,
+        "not_modified": sum(v for labels, v in metrics.get("rssnews_feed_responses_total", []) if labels.get("status") == "304"),
+        "new_items": total(metrics, "rssnews_feed_new_items_total"),
+        "p50": quantile(metrics, "rssnews_feed_process_seconds", 0.5),
+        "p99": quantile(metrics, "rssnews_feed_process_seconds", 0.99),
+        "peak_rss_mb": rss,
+    }
+
+
+def bench_article_spider(args, rc, stream):
+    port = free_port()
+    store = tempfile.mkdtemp(prefix="bench-html-")
+    cmd = [args.python, "-m", "scrapy", "crawl", "articlespider", "-s", "METRICS_PORT={0}".format(port),
+           "-s", "METRICS_INTERVAL=1", "-s", "HTML_STORE=file", "-s", "HTML_STORE_PATH={0}".format(store),
+           "-s", "LOG_LEVEL=WARNING"] + shlex.split(args.spider_args)
+    rc.set("article_spider", "start")
+    queued = rc.xlen(stream)
+    proc = subprocess.Popen(cmd, cwd=ROOT)
+    try:
+        metrics = wait_for_metrics(port, proc)
+        start = time()
+        while time() - start < args.duration and total(metrics, "rssnews_articles_stored_total") < queued:
+            sleep(1)
+            metrics = scrape(port)
+        elapsed = time() - start
+        rss = peak_rss(proc.pid)
+    finally:
+        rc.set("article_spider", "stop")
+        stop(proc)
+    articles = total(metrics, "rssnews_articles_stored_total")
+    return {
+        "queued": queued,
+        "articles": articles,
+        "articles_per_sec": articles / elapsed,
+        "p50": quantile(metrics, "rssnews_article_download_seconds", 0.5),
+        "p99": quantile(metrics, "rssnews_article_download_seconds", 0.99),
+        "extraction_p50": quantile(metrics, "rssnews_extraction_seconds", 0.5),
+        "extraction_p99": quantile(metrics, "rssnews_extraction_seconds", 0.99),
+        "peak_rss_mb": rss,
+    }
+
+
+def git_rev():
+    rev = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode("ascii").strip()
+    dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=ROOT) != 0
+    return rev + ("-dirty" if dirty else "")
+
+
+def compare(result, baseline):
+    print("{0:<14} {1:<18} {2:>12} {3:>12} {4:>8}".format("stage", "metric", baseline["rev"], result["rev"], "change"))
+    for stage in ("feed_updater", "article_spider"):
+        for key, value in sorted(result.get(stage, {}).items()):
+            old = baseline.get(stage, {}).get(key)
+            change = "{0:+.1f}%".format(100.0 * (value - old) / old) if value is not None and old else ""
+            print("{0:<14} {1:<18} {2:>12} {3:>12} {4:>8}".format(stage, key, fmt(old), fmt(value), change))
+
+
+def fmt(value):
+    return "-" if value is None else "{0:.4g}".format(value)
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="benchmark the feed updater and the article spider offline")
+    ap.add_argument("symbols", nargs="+", help="symbol lists, e.g. DJI.txt NDX.txt FTSE.txt")
+    ap.add_argument("--wipe", action="store_true", help="confirm that the local redis and mongodb can be wiped")
+    ap.add_argument("--mongodb-uri", type=str, default="mongodb://localhost:27017")
+    ap.add_argument("--redis-host", type=str, default="localhost")
+    ap.add_argument("--redis-port", type=int, default=6379)
+    ap.add_argument("--pages", nargs="*", default=[], help="article pages, generated ones by default")
+    ap.add_argument("--hosts", type=int, default=32, help="number of fake news sites")
+    ap.add_argument("--delay", type=float, default=0.0, help="simulated network latency in seconds")
+    ap.add_argument("--duration", type=float, default=60, help="max seconds per stage")
+    ap.add_argument("--mode", default="async", choices=["each", "all", "async"])
+    ap.add_argument("--update-interval", type=int, default=5)
+    ap.add_argument("--updater-args", type=str, default="", help="more feed_updater.py arguments, e.g. --updater-args='--adaptive'")
+    ap.add_argument("--spider-args", type=str, default="", help="more scrapy arguments, e.g. --spider-args='-s CONCURRENT_REQUESTS=64'")
+    ap.add_argument("--skip-spider", action="store_true")
+    ap.add_argument("--python", type=str, default=sys.executable)
+    ap.add_argument("--compare", type=str, default=None, help="saved result to compare with, git rev or file")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+    if not args.wipe:
+        ap.error("the benchmark wipes redis db 0/1 and the rssnews database, confirm with --wipe")
+
+    preflight(args)
+    rc = redis.Redis(host=args.redis_host, port=args.redis_port, db=0)
+    df = redis.Redis(host=args.redis_host, port=args.redis_port, db=1)
+    mc = pm.MongoClient(host=args.mongodb_uri)
+    server = FakeNewsServer(load_pages(args.pages), hosts=args.hosts, delay=args.delay).start()
+    nb_feeds = seed(mc, rc, df, server, args.symbols)
+    logging.info("%d feeds served on port %d", nb_feeds, server.port)
+
+    result = {
+        "rev": git_rev(),
+        "date": datetime.utcnow().isoformat(),
+        "config": {"feeds": nb_feeds, "mode": args.mode, "hosts": args.hosts, "delay": args.delay,
+                   "duration": args.duration, "update_interval": args.update_interval},
+    }
+    try:
+        result["feed_updater"] = bench_feed_updater(args, rc)
+        logging.info("feed updater: %s", result["feed_updater"])
+        if not args.skip_spider:
+            result["article_spider"] = bench_article_spider(args, rc, PENDING_STREAM)
+            logging.info("article spider: %s", result["article_spider"])
+    finally:
+        server.stop()
+        mc.close()
+
+    if not os.path.isdir(RESULTS):
+        os.makedirs(RESULTS)
+    with open(os.path.join(RESULTS, result["rev"] + ".json"), "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    if args.compare:
+        path = args.compare if os.path.isfile(args.compare) else os.path.join(RESULTS, args.compare + ".json")
+        with open(path) as f:
+            compare(result, json.load(f))
@@ -0,0 +1,63 @@
+"""
+Benchmark of the rss feed parsers.
+
+Compares rssparse.parse (lxml iterparse) with feedparser on saved feeds, e.g.
+
+    python benchmarks/bench_rssparse.py testfiles/yahoo_headline.xml --repeat 200
+
+Without files, feeds generated by the fake server with --items entries are used.
+"""
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+from timeit import default_timer
+import feedparser as fp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rssnewsbot import rssparse
+from fakeserver import FakeNewsServer
+
+
+def bench(func, feeds, repeat):
+    start = default_timer()
+    for _ in range(repeat):
+        for feed in feeds:
+            func(feed)
+    return (default_timer() - start) / (repeat * len(feeds))
+
+
+def records(entries):
+    return [(e.link, e.title, e.published_parsed) for e in entries]
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="benchmark rss feed parsing")
+    ap.add_argument("files", nargs="*")
+    ap.add_argument("--repeat", type=int, default=100)
+    ap.add_argument("--items", type=int, default=20)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    feeds = []
+    for fn in args.files:
+        with open(fn, "rb") as f:
+            feeds.append(f.read())
+    if not feeds:
+        server = FakeNewsServer([b""], items_per_feed=args.items)
+        feeds = [server.render_feed(symbol, 1) for symbol in ("AAPL", "MSFT", "IBM")]
+        server.server_close()
+
+    mismatches = 0
+    for feed in feeds:
+        fast, slow = rssparse.parse(feed), fp.parse(feed)
+        if records(fast.entries) != [(e.get("link"), e.get("title"), e.get("published_parsed")) for e in slow.entries if e.get("link")]:
+            mismatches += 1
+    logging.info("%d feeds, %d with different entries", len(feeds), mismatches)
+
+    t_fast = bench(rssparse.parse, feeds, args.repeat)
+    t_slow = bench(fp.parse, feeds, args.repeat)
+    logging.info("rssparse   %8.3f ms/feed", t_fast * 1000)
+    logging.info("feedparser %8.3f ms/feed", t_slow * 1000)
+    logging.info("speedup    %8.1fx", t_slow / t_fast)
@@ -0,0 +1,186 @@
+"""
+Local stand-in for the yahoo rss feeds and the news sites.
+
+Feeds are generated from a recorded feed (testfiles/yahoo_headline.xml):
+its channel is kept and its first item is cloned into items_per_feed items
+whose old style redirect links point back to this server, spread over
+127.0.0.1 ... 127.0.0.<hosts> so that the per-domain politeness of the
+article spider sees many sites. Every change_every fetches of a feed
+new_per_change items are added to it; in between, conditional requests get
+a 304. Every shared_every-th item is a market wide article shared by all
+symbols. Articles are served from the given pages in turn.
+
+    python benchmarks/fakeserver.py --port 8080
+"""
+import os
+import sys
+import copy
+import zlib
+import threading
+from time import time, sleep, gmtime, strftime
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from lxml import etree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FEED_TEMPLATE = os.path.join(ROOT, "testfiles", "yahoo_headline.xml")
+REDIRECT = "http://us.rd.yahoo.com/finance/external/bench/rss/SIG=0/*"
+
+
+class FeedState(object):
+    def __init__(self):
+        self.fetches = 0
+        self.revision = 0
+
+
+class FakeNewsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, port=0, hosts=16, items_per_feed=20, new_per_change=2, change_every=1,
+                 shared_every=10, delay=0.0, template=FEED_TEMPLATE):
+        HTTPServer.__init__(self, ("0.0.0.0", port), FakeNewsHandler)
+        self.pages = pages
+        self.hosts = hosts
+        self.items_per_feed = items_per_feed
+        self.new_per_change = new_per_change
+        self.change_every = change_every
+        self.shared_every = shared_every
+        self.delay = delay
+        self.channel = etree.parse(template).getroot().find("channel")
+        self.item = self.channel.find("item")
+        for item in self.channel.findall("item"):
+            self.channel.remove(item)
+        self.feeds = {}
+        self.lock = threading.Lock()
+        self.counts = {"feed": 0, "not_modified": 0, "article": 0, "not_found": 0}
+        self.started = time()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def feed_url(self, symbol):
+        return "http://127.0.0.1:{0}/rss/headline?s={1}".format(self.port, symbol)
+
+    def article_url(self, symbol, i):
+        host = zlib.crc32("{0}/{1}".format(symbol, i).encode("utf-8")) % self.hosts + 1
+        return "http://127.0.0.{0}:{1}/article/{2}/{3}".format(host, self.port, symbol, i)
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def poll(self, symbol):
+        """
+        register a fetch of the feed of symbol, returns its revision
+        """
+        with self.lock:
+            state = self.feeds.setdefault(symbol, FeedState())
+            if state.fetches % self.change_every == 0:
+                state.revision += 1
+            state.fetches += 1
+            return state.revision
+
+    def render_feed(self, symbol, revision):
+        channel = copy.deepcopy(self.channel)
+        last = revision * self.new_per_change + self.items_per_feed
+        now = time()
+        for i in range(last - 1, last - self.items_per_feed - 1, -1):
+            source = "market" if i % self.shared_every == 0 else symbol
+            item = copy.deepcopy(self.item)
+            item.find("title").text = "{0} headline {1}".format(source, i)
+            item.find("guid").text = "{0}-{1}".format(source, i)
+            item.find("link").text = REDIRECT + self.article_url(source, i)
+            item.find("pubDate").text = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime(now - (last - i) * 60))
+            channel.append(item)
+        rss = etree.Element("rss", version="2.0")
+        rss.append(channel)
+        return etree.tostring(rss, xml_declaration=True, encoding="UTF-8")
+
+    def page(self, path):
+        return self.pages[zlib.crc32(path.encode("utf-8")) % len(self.pages)]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-news-server")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeNewsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        if server.delay:
+            sleep(server.delay)
+        url = urlparse(self.path)
+        if url.path == "/rss/headline":
+            symbol = parse_qs(url.query).get("s", ["?"])[0]
+            revision = server.poll(symbol)
+            etag = '"{0}-{1}"'.format(symbol, revision)
+            if self.headers.get("If-None-Match") == etag:
+                server.count("not_modified")
+                self.respond(304, b"", etag=etag)
+            else:
+                server.count("feed")
+                self.respond(200, server.render_feed(symbol, revision), "application/rss+xml", etag)
+        elif url.path.startswith("/article/"):
+            server.count("article")
+            self.respond(200, server.page(url.path), "text/html; charset=utf-8")
+        else:
+            server.count("not_found")
+            self.respond(404, b"not found")
+
+    def respond(self, status, body, content_type="text/plain", etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def load_pages(files, nb_synthetic=20, paragraphs=30):
+    """
+    article pages: the non empty files, or generated pages when there are none
+    """
+    pages = []
+    for fn in files:
+        with open(fn, "rb") as f:
+            page = f.read()
+        if page:
+            pages.append(page)
+    if not pages:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from bench_extract import synthetic_page
+        pages = [synthetic_page(paragraphs, seed) for seed in range(nb_synthetic)]
+    return pages
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="serve generated rss feeds and article pages")
+    ap.add_argument("pages", nargs="*", help="article pages, generated ones by default")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--hosts", type=int, default=16)
+    ap.add_argument("--items-per-feed", type=int, default=20)
+    ap.add_argument("--new-per-change", type=int, default=2)
+    ap.add_argument("--change-every", type=int, default=1)
+    ap.add_argument("--delay", type=float, default=0.0, help="seconds before every response")
+    args = ap.parse_args()
+
+    server = FakeNewsServer(load_pages(args.pages), port=args.port, hosts=args.hosts, items_per_feed=args.items_per_feed,
+                            new_per_change=args.new_per_change, change_every=args.change_every, delay=args.delay)
+    print("serving on {0}, e.g. {1}".format(server.port, server.feed_url("AAPL")))
+    server.serve_forever()
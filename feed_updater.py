@@ -2,23 +2,37 @@
 from argparse import ArgumentParser
 from time import mktime, sleep, gmtime
 from multiprocessing import Pool, Process
+import os
+import atexit
+import threading
 import logging
-import urlparse
 import itertools
-import feedparser as fp
 import pymongo as pm
 import redis
 import msgpack
 import xxhash
 import requests
 from colorama import Back, Fore, Style
-from redlock import RedLock
+from rssnewsbot import rssparse, watermark
+from rssnewsbot.feedcache import NOT_MODIFIED, request_headers, changed_validators
+from rssnewsbot.scheduler import FeedScheduler
+from rssnewsbot.dedup import DedupFilter, NEW, NEW_SYMBOL
+from rssnewsbot.batching import WriteBatcher
+from rssnewsbot.resolver import RedirectResolver, is_redirect
+from rssnewsbot.cluster import ClusterMembership
+from rssnewsbot.fanout import FanOut, index_map
+from rssnewsbot.feedgroup import make_groups
+from rssnewsbot.storage import NewsStore
+from rssnewsbot import metrics
+from rssnewsbot.metrics import FEED_PROCESS_SECONDS, FEED_FETCH_SECONDS, FEED_PARSE_SECONDS, FEED_RESPONSES, FEED_NEW_ITEMS, CYCLE_NEW_ITEMS
 
 
 def hs(s):
     """
     hash function to convert url to fixed length hash code
     """
+    if not isinstance(s, bytes):
+        s = s.encode("utf-8")
     return xxhash.xxh32(s).hexdigest()
 
 
@@ -29,33 +43,25 @@ def time2ts(time_struct):
     return mktime(time_struct)
 
 
-def extract_url(url):
+TASK_STATE = ("updated", "updated_timestamps", "watermark", "etag", "last_modified")
+MEMBER_STATE = ("updated", "updated_timestamps")
+
+
+def task_state(task):
     """
-    extract the real url from yahoo rss feed item
+    the fields of a task changed by process(), which a pool worker (mode "all")
+    sends back so the parent's copy, used by the scheduler, stays current
     """
-    _url = None
-    if '*' in url:                                          # old style yahoo redirect link
-        _url = "http" + url.split("*http")[-1]
-    elif url.startswith("http://finance.yahoo.com/r/"):     # new style yahoo redirect link
-        headers = {
-            "User-Agent": "Mozilla/5.0 (iPad; U; CPU OS 4_2_1 like Mac OS X; en-gb) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8C148 Safari/6533.18.5",
-            "From": "http://finance.yahoo.com"
-        }
-        res = requests.get(url, headers=headers)
-        if res.status_code == 200:
-            page_source = res.text
-            if page_source.startswith("<script src="):      # yahoo now uses javascript to make page redirection
-                _url = page_source.split("URL=\'")[-1].split("\'")[0]
-            else:
-                _url = url # TODO: is this correct?
-        else:
-            logging.warning("%sabnormal http status code [%s] url=%s%s", Back.RED, res.status_code, url, Style.RESET_ALL)
-    else:
-        _url = url
-    # if _url is not None:
-    #     if "=yahoo" in _url:                                    # ignore redirect tracking parameters
-    #         _url = "{0}://{1}{2}".format(*urlparse.urlparse(_url))
-    return _url
+    state = dict((k, task[k]) for k in TASK_STATE if k in task)
+    state["members"] = [dict((k, m[k]) for k in MEMBER_STATE if k in m) for m in task.get("members", [])]
+    return state
+
+
+def apply_task_state(task, state):
+    state = dict(state)
+    for member, member_state in zip(task.get("members", []), state.pop("members", [])):
+        member.update(member_state)
+    task.update(state)
 
 
 if __name__ == "__main__":
@@ -65,9 +71,31 @@ if __name__ == "__main__":
     ap.add_argument("--redis-port", default=6379, type=int)
     ap.add_argument("--redis-pwd", default=None, type=str)
     ap.add_argument("--proxy", type=str, default="108.59.14.203:13010")
-    ap.add_argument("--mode", default="one", choices=["each", "all"])
+    ap.add_argument("--mode", default="one", choices=["each", "all", "async"])
     ap.add_argument("--procs", default=4, type=int)
+    ap.add_argument("--concurrency", default=100, type=int, help="max number of feed requests in flight (async mode)")
+    ap.add_argument("--per-host", default=8, type=int, help="max number of feed requests in flight per host (async mode)")
+    ap.add_argument("--threads", default=10, type=int, help="number of threads processing downloaded feeds (async mode)")
     ap.add_argument("--update-interval", type=int, default=60)
+    ap.add_argument("--group-size", type=int, default=1, help="number of symbols polled with one multi-symbol feed request")
+    ap.add_argument("--adaptive", action="store_true", help="poll each feed at a rate estimated from its update history")
+    ap.add_argument("--min-interval", type=float, default=5, help="shortest polling interval of a feed (adaptive)")
+    ap.add_argument("--max-interval", type=float, default=1800, help="longest polling interval of a feed (adaptive)")
+    ap.add_argument("--budget", type=float, default=20, help="max number of feed fetches per second (adaptive)")
+    ap.add_argument("--filter-capacity", type=int, default=1000000, help="number of urls in the first bloom filter slice")
+    ap.add_argument("--filter-error-rate", type=float, default=0.001, help="false positive rate of the first bloom filter slice")
+    ap.add_argument("--cluster", action="store_true", help="share the feeds with the other feed updaters registered in redis")
+    ap.add_argument("--node-id", type=str, default=None, help="name of this node in the cluster, defaults to host:pid")
+    ap.add_argument("--pending-stream", type=str, default="pending_stream", help="redis stream of the items pending download")
+    ap.add_argument("--resolver-threads", type=int, default=16, help="number of redirect links resolved concurrently")
+    ap.add_argument("--batch-size", type=int, default=500, help="max number of buffered redis/mongodb writes")
+    ap.add_argument("--batch-delay", type=float, default=1.0, help="max seconds a write stays buffered")
+    ap.add_argument("--publish-delay", type=float, default=0.05, help="max seconds a news event waits to be published")
+    ap.add_argument("--timestamps-window", type=int, default=200, help="number of update timestamps kept per feed")
+    ap.add_argument("--history-size", type=int, default=200, help="number of news events kept per symbol for replay")
+    ap.add_argument("--metrics-port", type=int, default=None, help="serve prometheus metrics on this port (only the feeds processed by the main process are counted)")
+    ap.add_argument("--profile-every", type=int, default=0, help="profile one in every n feed processings with cProfile")
+    ap.add_argument("--profile-path", type=str, default="feed_updater.prof", help="prefix of the profile stats files, one per process")
     ap.add_argument("-v", "--verbose", action="store_true")
     ap.add_argument("--debug", action="store_true")
     ap.add_argument("--dry-run", action="store_true")
@@ -79,62 +107,177 @@ if __name__ == "__main__":
     if args.debug:
         logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)-8s %(message)s")
 
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    profiler = metrics.SamplingProfiler(args.profile_every, args.profile_path)
+    if args.profile_every:
+        atexit.register(profiler.dump)
+
     mc = pm.MongoClient(host=args.mongodb_uri, connect=False)
     rc = redis.Redis(host=args.redis_host, port=args.redis_port, password=args.redis_pwd, db=0)
     df = redis.Redis(host=args.redis_host, port=args.redis_port, password=args.redis_pwd, db=1)
-    lock = RedLock([{"host": args.redis_host, "port": args.redis_port, "db": 3}])
+    store = NewsStore(pm.MongoClient(host=args.mongodb_uri, connect=False).rssnews, timestamps_window=args.timestamps_window)
+    dedup = DedupFilter(df, store,
+                        capacity=args.filter_capacity, error_rate=args.filter_error_rate)
 
-    logging.info("building filter ...")
-    with mc.rssnews.news.find({}, {"uuid": True}) as cursor:
-        for news_item in cursor:
-            if df.scard(news_item["uuid"]) == 0:
-                for sym in news_item["symbols"]:
-                    df.sadd(news_item["uuid"], sym)
-        logging.info("%d existing urls in total.", df.dbsize())
+    def command():
+        """
+        value of the feed_updater key: "start", "stop" or None
+        """
+        cmd = rc.get("feed_updater")
+        return cmd.decode("utf-8") if isinstance(cmd, bytes) else cmd
+
+    def warm_filter():
+        """
+        add the news stored since the last warm-up to the filter, runs in the
+        background with its own connections while the feeds are already polled
+        """
+        warm_mc = pm.MongoClient(host=args.mongodb_uri)
+        try:
+            warm_df = redis.Redis(host=args.redis_host, port=args.redis_port, password=args.redis_pwd, db=1)
+            warmer = DedupFilter(warm_df, NewsStore(warm_mc.rssnews),
+                                 capacity=args.filter_capacity, error_rate=args.filter_error_rate)
+            nb_legacy = warmer.migrate_legacy()
+            if nb_legacy:
+                logging.info("moved %d legacy uuid sets into the filter", nb_legacy)
+            nb_added = warmer.warm()
+            logging.info("filter warmed up, %d urls added, %d existing urls in total.", nb_added, warmer.count())
+        except Exception:
+            logging.exception("error warming up filter")
+        finally:
+            warm_mc.close()
+
+    logging.info("building filter in the background ...")
+    warm_thread = threading.Thread(target=warm_filter, name="filter-warmer")
+    warm_thread.daemon = True
+    warm_thread.start()
 
     logging.info("generating tasks ...")
+    NewsStore(mc.rssnews).ensure_feed_indexes()
+    logging.info("number of rss feeds = %d", mc.rssnews.feed.count_documents({}))
     with mc.rssnews.feed.find() as cursor:
-        logging.info("number of rss feeds = %d", cursor.count())
         tasks = []
         for item in cursor:
             logging.debug("rss=%(url)s", item)
-            t = [len(tasks), item["_id"], item["symbol"], item["url"], item.get("updated", 0)]
-            tasks.append(t)
+            item["tid"] = len(tasks)
+            item.setdefault("updated", 0)
+            tasks.append(item)
+    if args.group_size > 1:
+        tasks = make_groups(tasks, args.group_size, mc.rssnews.feed_group)
+        logging.info("polling the feeds in %d groups of up to %d symbols", len(tasks), args.group_size)
     mc.close()
 
-    def process(task, mongodb_cli=None):
+    batchers = {}
+
+    def batcher():
+        """
+        write batcher of the current process, created on first use since the
+        flushing thread does not survive a fork
+        """
+        pid = os.getpid()
+        if pid not in batchers:
+            batchers[pid] = WriteBatcher(rc, pm.MongoClient(host=args.mongodb_uri, connect=False),
+                                         max_size=args.batch_size, max_delay=args.batch_delay)
+            atexit.register(batchers[pid].close)
+        return batchers[pid]
+
+    fanouts = {}
+    indexes = index_map(m for t in tasks for m in t.get("members", [t]))
+
+    def fanout():
+        """
+        news event publisher of the current process, created on first use like the write batcher
+        """
+        pid = os.getpid()
+        if pid not in fanouts:
+            fanouts[pid] = FanOut(rc, indexes, max_delay=args.publish_delay, history=args.history_size)
+            atexit.register(fanouts[pid].close)
+        return fanouts[pid]
+
+    def flush_process():
+        """
+        send the writes and events buffered by the current process; pool workers
+        (mode "all") exit through os._exit without running atexit, so they flush
+        after every feed instead of leaving entries marked as seen unwritten
+        """
+        pid = os.getpid()
+        if pid in batchers:
+            batchers[pid].flush()
+        if pid in fanouts:
+            fanouts[pid].flush()
+
+    resolvers = {}
+
+    def resolver():
+        """
+        redirect resolver of the current process, its thread pool does not survive a fork
+        """
+        pid = os.getpid()
+        if pid not in resolvers:
+            resolvers[pid] = RedirectResolver(df, workers=args.resolver_threads)
+        return resolvers[pid]
+
+    @FEED_PROCESS_SECONDS.timed
+    @profiler
+    def process(task, mongodb_cli=None, rss_xml=None, validators=None):
         """
         Core process function to parse rss single feed and extract feed items
         only new item will be pushed into the pending queue for spider to download.
+        Entries covered by the watermark of the feed (see rssnewsbot/watermark.py) are skipped.
+        A group task (see rssnewsbot/feedgroup.py) maps every entry to the symbols it mentions,
+        or to all the symbols of the group if it mentions none of them.
+        rss_xml is the feed body if it has already been downloaded, e.g. by the async poller,
+        validators are the (etag, last_modified) response headers of that download.
         """
-        tid, _id, symbol, rss_url, rss_updated = task
+        tid, _id, symbol, rss_url, rss_updated = task["tid"], task["_id"], task["symbol"], task["url"], task["updated"]
         logging.debug("processing tid=%03d, _id=%s, sym=%5s, rss_url=%s, updated=%d", tid, _id, symbol, rss_url, rss_updated)
-        if args.proxy:
+        if rss_xml is None:
             try:
-                rss_xml = requests.get(rss_url, proxies={"http": args.proxy})
+                with FEED_FETCH_SECONDS.time():
+                    res = requests.get(rss_url, headers=request_headers(task),
+                                       proxies={"http": args.proxy} if args.proxy else None)
             except:
                 logging.warning("%serror loading feed, tid=%03d, _id=%s, sym=%5s, rss_url=%s, updated=%d%s", Back.RED, tid, _id, symbol, rss_url, rss_updated, Style.RESET_ALL)
-                return
-            try:
-                rss = fp.parse(rss_xml)
-            except:
-                logging.warning("%serror parsing feed, tid=%03d, _id=%s, sym=%5s, rss_url=%s, updated=%d%s", Back.RED, tid, _id, symbol, rss_url, rss_updated, Style.RESET_ALL)
-                return
-        else:
-            rss = fp.parse(rss_url)
+                return 0
+            FEED_RESPONSES.inc(status=res.status_code)
+            if res.status_code == NOT_MODIFIED:
+                logging.debug("not modified, tid=%03d, sym=%5s", tid, symbol)
+                return 0
+            if res.status_code != 200:
+                logging.warning("%sabnormal http status code [%s], sym=%5s, rss_url=%s%s", Back.RED, res.status_code, symbol, rss_url, Style.RESET_ALL)
+                return 0
+            rss_xml = res.content
+            validators = (res.headers.get("ETag"), res.headers.get("Last-Modified"))
+        try:
+            with FEED_PARSE_SECONDS.time():
+                rss = rssparse.parse(rss_xml)
+        except:
+            logging.warning("%serror parsing feed, tid=%03d, _id=%s, sym=%5s, rss_url=%s, updated=%d%s", Back.RED, tid, _id, symbol, rss_url, rss_updated, Style.RESET_ALL)
+            return 0
         nb_new_items = 0
-        for e in rss.entries:
-            url = extract_url(e.link)
+        new_symbols = {}        # symbol -> number of its new items
+        head = watermark.new_entries(task, rss.entries)
+        logging.debug("%d of %d entries past the watermark, sym=%5s", len(head), len(rss.entries), symbol)
+        if "members" in task:
+            matched = [(e, task["matcher"].match(e.title)) for e in head]
+        else:
+            matched = [(e, [symbol]) for e in head]
+        matched = [(e, symbols) for e, symbols in matched if not (is_redirect(e.link) and dedup.seen_link(e.link, symbols))]
+        urls = resolver().resolve_many([e.link for e, _ in matched])
+        failed = set()
+        for e, symbols in matched:
+            url = urls[e.link]
             if url is None:
                 logging.warning("%sfail to extract url, sym=%s, link=%s%s", Back.RED, symbol, e.link, Style.RESET_ALL)
+                failed.add(e.link)
                 continue
             uuid = hs(url)
-            lock.acquire()
-            if df.scard(uuid) == 0:
-                logging.info("%sadd to pending queue: sym=%5s, uuid=%s, url=%s%s", Fore.GREEN, symbol, uuid, url, Style.RESET_ALL)
-                df.sadd(uuid, symbol)
-                lock.release()
-                published = e.get("published_parsed", None)
+            statuses = [(s, dedup.check_and_add(uuid, s)) for s in symbols]
+            new = [s for s, status in statuses if status == NEW]
+            added = [s for s, status in statuses if status == NEW_SYMBOL]
+            if new:
+                logging.info("%sadd to pending queue: sym=%5s, uuid=%s, url=%s%s", Fore.GREEN, ",".join(new + added), uuid, url, Style.RESET_ALL)
+                published = e.published_parsed
                 if published:
                     published = time2ts(published)
                 entry = {
@@ -143,55 +286,90 @@ if __name__ == "__main__":
                     "link": e.link,
                     "url": url,
                     "published": published,
-                    "symbols": [symbol]
+                    "symbols": new + added
                 }
                 mp = msgpack.packb(entry)
-                rc.lpush("pending", mp)
-                rc.publish("news_"+symbol, mp)
+                batcher().redis("xadd", args.pending_stream, {"item": mp})
+                for s in new + added:
+                    fanout().news(s, entry)
+            elif added:
+                store.add_symbols(batcher(), uuid, added)
+                for s in added:
+                    fanout().symbol_added(uuid, s)
+                logging.info("%sadd %s to %s%s", Fore.GREEN, ",".join(added), uuid, Style.RESET_ALL)
+            for s in new + added:
+                new_symbols[s] = new_symbols.get(s, 0) + 1
+            if new or added:
                 nb_new_items += 1
-            else:
-                if not df.sismember(uuid, symbol):
-                    df.sadd(uuid, symbol)
-                    mongodb_cli.rssnews.news.update_one({"uuid":uuid}, {"$addToSet": {"symbols": symbol}})
-                    logging.info("%sadd %s to %s%s", Fore.GREEN, symbol, uuid, Style.RESET_ALL)
-                    nb_new_items += 1
-                lock.release()
+            if is_redirect(e.link):
+                dedup.mark_link(e.link, symbols)
+        FEED_NEW_ITEMS.inc(nb_new_items)
+        feed_update = {}
         if nb_new_items > 0:
-            if hasattr(rss.feed, "updated_parsed"):
-                updated = time2ts(rss.feed.updated_parsed)
+            if rss.updated_parsed is not None:
+                updated = time2ts(rss.updated_parsed)
             else:
                 updated = mktime(gmtime())
-            if mongodb_cli is None:
-                with pm.MongoClient(args.mongodb_uri, connect=False) as temp_mc:
-                    temp_mc.rssnews.feed.find_one_and_update(
-                        {"_id": _id},
-                        {"$push": {"updated_timestamps": updated}, "$set": {"updated": updated}}
-                    )
-            else:
-                mongodb_cli.rssnews.feed.find_one_and_update(
-                    {"_id": _id},
-                    {"$push": {"updated_timestamps": updated}, "$set": {"updated": updated}}
-                )
+            feed_update = {"$push": {"updated_timestamps": updated}, "$set": {"updated": updated}}
+            task["updated"] = updated
+            task["updated_timestamps"] = (task.get("updated_timestamps") or [])[-args.timestamps_window + 1:] + [updated]
             logging.info("%sadded %d new items to %s%s", Back.GREEN, nb_new_items, symbol, Style.RESET_ALL)
+            for member in task.get("members", []):       # per-symbol bookkeeping of a group feed
+                if member["symbol"] in new_symbols:
+                    member["updated"] = updated
+                    member["updated_timestamps"] = (member.get("updated_timestamps") or [])[-args.timestamps_window + 1:] + [updated]
+                    store.update_feed(batcher(), "feed", member["_id"], {"$push": {"updated_timestamps": updated}, "$set": {"updated": updated}})
+        mark = watermark.advance(task, rss.entries, failed)
+        if mark is not None:
+            task["watermark"] = mark
+            feed_update.setdefault("$set", {})["watermark"] = mark
+        if validators is not None and not failed:     # a 304 would hide the failed entries from the next poll
+            changed = changed_validators(task, *validators)
+            if changed:
+                task.update(changed)
+                feed_update.setdefault("$set", {}).update(changed)
+        if feed_update and "members" in task:
+            store.update_feed(batcher(), "feed_group", _id, feed_update, upsert=True)
+        elif feed_update:
+            store.update_feed(batcher(), "feed", _id, feed_update)
         return nb_new_items
 
+    cluster = None
+    if args.cluster:
+        cluster = ClusterMembership(rc, node_id=args.node_id)
+        cluster.start()
+        atexit.register(cluster.leave)
+        logging.info("joined cluster as %s", cluster.node_id)
+
+    def owned(task):
+        """
+        whether this node polls the feed, always true without --cluster
+        """
+        return cluster is None or cluster.owns(str(task["_id"]))
+
+    scheduler = FeedScheduler(tasks if args.adaptive else [], min_interval=args.min_interval,
+                              max_interval=args.max_interval, default_interval=args.update_interval,
+                              budget=args.budget)
+
     class FeedWorker(object):
         def __init__(self, mc):
             self.mc = mc
             self.cmd = None
 
         def __call__(self, task):
-            symbol = task[2]
+            symbol = task["symbol"]
             while True:
-                self.cmd = rc.get("feed_updater")
+                self.cmd = command()
                 if self.cmd == "start":
-                    process(task, mongodb_cli=self.mc)
+                    if owned(task):
+                        process(task, mongodb_cli=self.mc)
                 elif self.cmd == "stop":
                     logging.info("%s%s process stopped%s", Back.RED, symbol, Style.RESET_ALL)
                     break
-                if args.update_interval > 1:
-                    logging.info("%s%s process sleep for %d seconds%s", Fore.GREEN, symbol, args.update_interval, Style.RESET_ALL)
-                    sleep(args.update_interval)
+                interval = scheduler.interval(task) if args.adaptive else args.update_interval
+                if interval > 1:
+                    logging.info("%s%s process sleep for %d seconds%s", Fore.GREEN, symbol, interval, Style.RESET_ALL)
+                    sleep(interval)
 
     if args.mode == "each":     # each rss feed has its own process
         mcs = [pm.MongoClient(host=args.mongodb_uri, connect=False) for _ in tasks]
@@ -206,26 +384,116 @@ if __name__ == "__main__":
     elif args.mode == "all":    # all rss feeds are processed by a pool of workers
         logging.info("use %d processes", args.procs)
         mcs = [pm.MongoClient(host=args.mongodb_uri, connect=False) for x in range(len(tasks))]
+
+        def processx(task_i):
+            t, i = task_i
+            try:
+                return process(t, mcs[i]), task_state(t)
+            finally:
+                flush_process()
+
+        pool = Pool(args.procs) if args.procs > 1 else None       # forked once, reused by every cycle
         while True:
-            cmd = rc.get("feed_updater")
+            cmd = command()
+            interval = args.update_interval
             if cmd == "start":
-                if args.procs > 1:
-                    def processx(task_i):
-                        t, i = task_i
-                        process(t, mcs[i])
-                    pool = Pool(args.procs)
-                    argpacks = zip(tasks, range(len(tasks)))
-                    nb_new = sum(pool.map(processx, argpacks))
+                due = scheduler.due(accept=owned) if args.adaptive else [t for t in tasks if owned(t)]
+                if pool is not None:
+                    argpacks = zip(due, range(len(due)))
+                    results = pool.map(processx, argpacks)
+                    for t, (_, state) in zip(due, results):     # the workers changed copies of the tasks
+                        apply_task_state(t, state)
+                    nb_new = sum(n for n, _ in results)
                 else:
-                    nb_new = sum([process(t, mcs[0]) for t in tasks])
+                    nb_new = sum([process(t, mcs[0]) for t in due])
+                CYCLE_NEW_ITEMS.set(nb_new)
                 if nb_new > 0:
                     logging.info("%sadded %d new items%s", Back.GREEN, nb_new, Style.RESET_ALL)
+                if args.adaptive:
+                    for t in due:
+                        scheduler.reschedule(t)
+                    interval = scheduler.next_due()
             elif cmd == "stop":
                 logging.info("%supdater stopped%s", Back.RED, Style.RESET_ALL)
                 break
             else:
                 logging.info("%schange value of 'feed_updater' to 'start' to start updating feeds.%s", Fore.RED, Style.RESET_ALL)
-            if args.update_interval > 1:
-                logging.info("%swait for %d seconds%s", Fore.GREEN, args.update_interval, Style.RESET_ALL)
-                sleep(args.update_interval)
+            if args.adaptive and cmd == "start":
+                sleep(interval)
+            elif interval > 1:
+                logging.info("%swait for %d seconds%s", Fore.GREEN, interval, Style.RESET_ALL)
+                sleep(interval)
+        if pool is not None:
+            pool.close()
+            pool.join()
         [x.close() for x in mcs]
+    elif args.mode == "async":  # all rss feeds are polled concurrently from a single event loop
+        from twisted.internet import reactor, defer, threads, task as ttask
+        from twisted.python.failure import Failure
+        from rssnewsbot.feedpoller import FeedPoller
+
+        amc = pm.MongoClient(host=args.mongodb_uri, connect=False)
+
+        def handle_feed(task, status, headers, body):
+            if status == NOT_MODIFIED:
+                logging.debug("not modified, tid=%03d, sym=%5s", task["tid"], task["symbol"])
+                return 0
+            if status != 200:
+                logging.warning("%sabnormal http status code [%s], sym=%5s, rss_url=%s%s", Back.RED, status, task["symbol"], task["url"], Style.RESET_ALL)
+                return 0
+            validators = [(headers.getRawHeaders(k) or [None])[-1] for k in (b"etag", b"last-modified")]
+            return process(task, mongodb_cli=amc, rss_xml=body, validators=validators)
+
+        poller = FeedPoller(handle_feed, concurrency=args.concurrency, per_host=args.per_host,
+                            nb_threads=args.threads, proxy=args.proxy)
+        logging.info("polling %d feeds, concurrency=%d, per host=%d", len(tasks), args.concurrency, args.per_host)
+
+        polling = set()
+
+        def poll_scheduled(task):
+            """
+            poll a task popped from the scheduler and hand it back once done
+            """
+            def finished(nb_new):
+                scheduler.reschedule(task)
+                return nb_new
+            d = poller.poll(task).addBoth(finished)
+            polling.add(d)
+            d.addBoth(lambda nb_new: polling.discard(d) or nb_new)
+
+        @defer.inlineCallbacks
+        def updater():
+            while True:
+                cmd = yield threads.deferToThread(command)
+                interval = args.update_interval
+                if cmd == "start":
+                    if args.adaptive:   # fire the due feeds and come back when the next one is due
+                        for t in scheduler.due(accept=owned):
+                            poll_scheduled(t)
+                        interval = min(scheduler.next_due(), 1.0)
+                    else:
+                        nb_new = yield poller.poll_all([t for t in tasks if owned(t)])
+                        CYCLE_NEW_ITEMS.set(nb_new)
+                        if nb_new > 0:
+                            logging.info("%sadded %d new items%s", Back.GREEN, nb_new, Style.RESET_ALL)
+                elif cmd == "stop":
+                    logging.info("%supdater stopped%s", Back.RED, Style.RESET_ALL)
+                    break
+                else:
+                    logging.info("%schange value of 'feed_updater' to 'start' to start updating feeds.%s", Fore.RED, Style.RESET_ALL)
+                if args.adaptive and cmd == "start":
+                    yield ttask.deferLater(reactor, interval, lambda: None)
+                elif interval > 1:
+                    logging.info("%swait for %d seconds%s", Fore.GREEN, interval, Style.RESET_ALL)
+                    yield ttask.deferLater(reactor, interval, lambda: None)
+            yield defer.DeferredList(list(polling))
+            yield poller.close()
+
+        def done(result):
+            if isinstance(result, Failure):
+                logging.error("%supdater failed: %s%s", Back.RED, result.getTraceback(), Style.RESET_ALL)
+            amc.close()
+            reactor.stop()
+
+        reactor.callWhenRunning(lambda: updater().addBoth(done))
+        reactor.run()
@@ -28,14 +28,18 @@ if __name__ == "__main__":
 
     for fname in args.fname:
         logging.info("processing file %s", fname)
+        index = os.path.splitext(os.path.basename(fname))[0]
         with open(fname, 'r') as f:
             for line in f.readlines():
                 symbol, company = line.strip().split('\t')
                 logging.info("adding %s, %s", symbol, company)
-                mc.rssnews.feed.insert({
-                    "symbol": symbol,
-                    "company": company,
-                    "url": "http://finance.yahoo.com/rss/headline?s={0}".format(symbol)
-                })
+                # one feed per symbol, listed in every index it belongs to (e.g. MSFT in DJI and NDX)
+                mc.rssnews.feed.update_one({"symbol": symbol}, {
+                    "$set": {
+                        "company": company,
+                        "url": "http://finance.yahoo.com/rss/headline?s={0}".format(symbol)
+                    },
+                    "$addToSet": {"indexes": index}
+                }, upsert=True)
         mc.close()
         logging.info("done")
@@ -0,0 +1,167 @@
+"""
+Read API of the latest news per symbol.
+
+    GET /news/<symbol>?limit=20                 latest news of a symbol, from memory
+    GET /news/<symbol>?before=<epoch>&limit=20  older news, from the indexed news buckets
+    GET /news?symbols=AAPL,MSFT&limit=5         latest news of a watchlist, from memory
+    GET /metrics                                prometheus metrics
+
+Unknown symbols (not in the feed list) get a 404, a limit below 1 a 400.
+Responses are JSON, or msgpack with ?format=msgpack or "Accept: application/x-msgpack".
+Reads from memory carry an ETag changing with the news of their symbols, so
+polling with If-None-Match costs a 304 until something new is published.
+"""
+from argparse import ArgumentParser
+from time import sleep, time
+import json
+import logging
+import threading
+try:
+    from urlparse import urlparse, parse_qsl
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from urllib.parse import urlparse, parse_qsl
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+import pymongo as pm
+import redis
+import msgpack
+import xxhash
+from rssnewsbot.storage import NewsStore
+from rssnewsbot.newscache import NewsCache
+from rssnewsbot.metrics import REGISTRY, API_REQUEST_SECONDS, API_READS
+
+BOOT = "{0:x}".format(int(time()))
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class NewsHandler(BaseHTTPRequestHandler):
+    cache = None
+    store = None
+    max_limit = 500
+
+    def do_GET(self):
+        parts = urlparse(self.path)
+        path = parts.path.rstrip("/").split("/")[1:]
+        query = dict(parse_qsl(parts.query))
+        if path == ["metrics"]:
+            self.send_body(REGISTRY.render().encode("utf-8"), "text/plain; version=0.0.4")
+            return
+        try:
+            limit = min(int(query.get("limit", 20)), self.max_limit)
+            before = float(query["before"]) if "before" in query else None
+            if limit < 1:
+                raise ValueError(limit)
+        except ValueError:
+            self.send_error(400, "invalid limit or before")
+            return
+        if len(path) == 2 and path[0] == "news":
+            if not self.cache.known(path[1]):
+                self.send_error(404, "unknown symbol")
+            elif before is None and limit <= self.cache.size:
+                with API_REQUEST_SECONDS.time(endpoint="symbol"):
+                    version, items = self.cache.latest(path[1], limit)
+                    self.send_news(items, "{0}-{1}".format(BOOT, version))
+            else:
+                with API_REQUEST_SECONDS.time(endpoint="history"):
+                    API_READS.inc(source="history")
+                    self.send_news(self.store.latest(path[1], limit, before))
+        elif path == ["news"] and query.get("symbols"):
+            symbols = query["symbols"].split(",")
+            unknown = [x for x in symbols if not self.cache.known(x)]
+            if unknown:
+                self.send_error(404, "unknown symbols " + ",".join(unknown))
+                return
+            with API_REQUEST_SECONDS.time(endpoint="watchlist"):
+                news, versions = {}, []
+                for symbol in symbols:
+                    version, news[symbol] = self.cache.latest(symbol, min(limit, self.cache.size))
+                    versions.append("{0}:{1}".format(symbol, version))
+                self.send_news(news, "{0}-{1}".format(BOOT, xxhash.xxh64(",".join(versions).encode("utf-8")).hexdigest()))
+        else:
+            self.send_error(404)
+
+    def send_news(self, news, etag=None):
+        if etag is not None:
+            etag = '"{0}"'.format(etag)
+            if self.headers.get("If-None-Match") == etag:
+                API_READS.inc(source="not_modified")
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            API_READS.inc(source="memory")
+        query = dict(parse_qsl(urlparse(self.path).query))
+        if query.get("format") == "msgpack" or "application/x-msgpack" in (self.headers.get("Accept") or ""):
+            self.send_body(msgpack.packb(news), "application/x-msgpack", etag)
+        else:
+            self.send_body(json.dumps(news, default=str).encode("utf-8"), "application/json", etag)
+
+    def send_body(self, body, content_type, etag=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="serve the latest news per symbol")
+    ap.add_argument("--mongodb-uri", type=str, default="mongodb://localhost:27017")
+    ap.add_argument("--redis-host", type=str, default="localhost")
+    ap.add_argument("--redis-port", default=6379, type=int)
+    ap.add_argument("--redis-pwd", default=None, type=str)
+    ap.add_argument("--host", type=str, default="")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--cache-size", type=int, default=100, help="number of news kept in memory per symbol")
+    ap.add_argument("--history-months", type=int, default=3, help="number of monthly news buckets searched for history")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
+
+    mc = pm.MongoClient(host=args.mongodb_uri)
+    rc = redis.Redis(host=args.redis_host, port=args.redis_port, password=args.redis_pwd, db=0)
+    store = NewsStore(mc.rssnews, lookup_months=args.history_months)
+    symbols = [x["symbol"] for x in mc.rssnews.feed.find({}, {"symbol": True})]
+    cache = NewsCache(size=args.cache_size, store=store, symbols=symbols)
+
+    ready = threading.Event()
+
+    def follow():
+        """
+        keep the cache fed, the history is replayed again after a reconnection
+        """
+        while True:
+            try:
+                cache.follow(rc, symbols, ready)
+            except redis.ConnectionError:
+                logging.exception("lost the news channels, reconnecting")
+                sleep(1)
+
+    follower = threading.Thread(target=follow, name="news-follower")
+    follower.daemon = True
+    follower.start()
+    if not ready.wait(60):
+        logging.warning("serving before the news history of %d symbols is replayed", len(symbols))
+
+    handler = type("Handler", (NewsHandler,), {"cache": cache, "store": store})
+    server = ThreadedHTTPServer((args.host, args.port), handler)
+    logging.info("serving news on port %d", args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        mc.close()
@@ -0,0 +1,227 @@
+"""
+Write batching for redis and mongodb.
+
+Writes are buffered and sent as one redis pipeline plus one bulk_write per
+mongodb collection, either when max_size writes are buffered or max_delay
+seconds after the first buffered write. Mongodb writes are flushed before the
+redis commands. Redis commands that depend on a mongodb write (e.g. pushing
+the _id of an inserted document to a queue) are buffered with it as its
+"then" commands and only sent if that write succeeded; its "on_duplicate"
+commands are sent instead if it failed on a duplicate key, i.e. it was
+already done (e.g. acking a pending entry whose document was stored before).
+
+A batch whose bulk_write fails as a whole (connection lost, timeout, any
+other error) or whose redis pipeline fails is put back in the buffer and
+retried after retry_delay seconds. The writes that cannot be encoded (bson
+or redis protocol) are logged and dropped instead, so they do not block the
+others; otherwise writes are only dropped by close().
+
+The buffering itself (size and delay triggers, background thread, retry
+delay) is BufferedFlusher, shared with the news event fan-out.
+"""
+import logging
+import threading
+from time import time
+from collections import defaultdict
+import bson
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+from colorama import Back, Style
+from .metrics import REDIS_SECONDS, MONGO_SECONDS
+
+
+class BufferedFlusher(object):
+    """
+    buffer flushed when max_size items are added or max_delay seconds after the
+    first one, by a daemon thread; subclasses implement reset() (create empty
+    buffers), swap() (return the buffers and reset them) and write(buffers)
+    """
+    name = "flusher"
+
+    def __init__(self, max_size, max_delay, retry_delay=5.0):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.retry_at = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.size = 0
+        self.first = None
+        self.reset()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, append):
+        with self.lock:
+            append()
+            self.size += 1
+            if self.first is None:
+                self.first = time()
+            full = self.size >= self.max_size and time() >= self.retry_at
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.size:
+                    return
+                buffers = self.swap()
+                self.size, self.first = 0, None
+            self.retry_at = 0
+            self.write(buffers)
+
+    def retry_later(self, count):
+        """
+        count items were put back in the buffer (under the lock), delay the next flush
+        """
+        self.size += count
+        if self.first is None:
+            self.first = time()
+        self.retry_at = time() + self.retry_delay
+
+    def run(self):
+        while not self.closed.wait(self.max_delay / 4.0):
+            first = self.first
+            if first is not None and time() - first >= self.max_delay and time() >= self.retry_at:
+                try:
+                    self.flush()
+                except Exception:
+                    logging.exception("error flushing %s", self.name)
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        if self.size:
+            logging.error("%s%s dropped %d unflushed items%s", Back.RED, self.name, self.size, Style.RESET_ALL)
+
+
+def mongo_encodable(op):
+    """
+    whether the documents of a buffered (pymongo op, then, on_duplicate) write can be encoded to bson
+    """
+    try:
+        for doc in (getattr(op[0], "_filter", None), getattr(op[0], "_doc", None)):
+            if doc is not None:
+                bson.encode(doc)
+    except Exception:
+        return False
+    return True
+
+
+class WriteBatcher(BufferedFlusher):
+    name = "write-batcher"
+
+    def __init__(self, rc, mc, max_size=500, max_delay=1.0, retry_delay=5.0):
+        self.rc = rc
+        self.mc = mc
+        # packs redis commands without connecting, to find the ones that cannot be encoded
+        self.packer = rc.connection_pool.connection_class(**rc.connection_pool.connection_kwargs)
+        super(WriteBatcher, self).__init__(max_size, max_delay, retry_delay)
+
+    def reset(self):
+        self.redis_ops = []
+        self.mongo_ops = defaultdict(list)
+
+    def swap(self):
+        buffers = self.redis_ops, self.mongo_ops
+        self.reset()
+        return buffers
+
+    def redis(self, cmd, *args):
+        """
+        buffer a redis command, e.g. batcher.redis("lpush", "nlp", str(_id))
+        """
+        self.add(lambda: self.redis_ops.append((cmd, args)))
+
+    def mongo(self, db, collection, op, then=(), on_duplicate=()):
+        """
+        buffer a pymongo write operation (InsertOne, UpdateOne, ...) on db.collection,
+        then is a list of (cmd, args) redis commands sent only once op succeeded,
+        on_duplicate the ones sent if op failed on a duplicate key
+        """
+        self.add(lambda: self.mongo_ops[(db, collection)].append((op, list(then), list(on_duplicate))))
+
+    def write(self, buffers):
+        redis_ops, mongo_ops = buffers
+        retry = {}
+        for (db, collection), ops in mongo_ops.items():
+            failed, duplicates = set(), set()
+            try:
+                with MONGO_SECONDS.time(op="bulk_write"):
+                    self.mc[db][collection].bulk_write([x[0] for x in ops], ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                duplicates = set(x["index"] for x in errors if x.get("code") == DUPLICATE_KEY)
+                failed = set(x["index"] for x in errors) - duplicates
+                if failed:
+                    logging.warning("%sbulk write to %s.%s failed: %s%s", Back.RED, db, collection,
+                                    [x for x in errors if x["index"] in failed], Style.RESET_ALL)
+                if duplicates:
+                    logging.info("%d writes to %s.%s were already done", len(duplicates), db, collection)
+            except Exception:
+                logging.exception("bulk write to %s.%s failed", db, collection)
+                retry[(db, collection)] = self.bury(ops, mongo_encodable, "mongodb %s.%s" % (db, collection))
+                logging.warning("%d writes to %s.%s kept for retry", len(retry[(db, collection)]), db, collection)
+                continue
+            for i, (_, then, on_duplicate) in enumerate(ops):
+                if i in duplicates:
+                    redis_ops.extend(on_duplicate)
+                elif i not in failed:
+                    redis_ops.extend(then)
+        if redis_ops:
+            pipe = self.rc.pipeline(transaction=False)
+            for cmd, args in redis_ops:
+                getattr(pipe, cmd)(*args)
+            try:
+                with REDIS_SECONDS.time(op="pipeline"):
+                    results = pipe.execute(raise_on_error=False)
+                for (cmd, args), res in zip(redis_ops, results):
+                    if isinstance(res, Exception):
+                        logging.warning("%sredis %s %s failed: %s%s", Back.RED, cmd, args[:1], res, Style.RESET_ALL)
+            except Exception:
+                logging.exception("redis pipeline failed")
+                redis_ops = self.bury(redis_ops, self.redis_encodable, "redis")
+                logging.warning("%d redis commands kept for retry", len(redis_ops))
+                self.requeue(redis_ops, retry)
+                return
+        if retry:
+            self.requeue([], retry)
+            return
+        logging.debug("flushed %d redis and %d mongodb writes", len(redis_ops), sum(len(x) for x in mongo_ops.values()))
+
+    def redis_encodable(self, op):
+        cmd, args = op
+        pipe = self.rc.pipeline(transaction=False)
+        try:
+            getattr(pipe, cmd)(*args)
+            self.packer.pack_commands([x for x, _ in pipe.command_stack])
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def bury(ops, encodable, target):
+        """
+        the ops that can be encoded, the others are logged and dropped
+        """
+        kept = [x for x in ops if encodable(x)]
+        if len(kept) < len(ops):
+            for op in ops:
+                if not encodable(op):
+                    logging.error("%sdropping a %s write that cannot be encoded: %r%s", Back.RED, target, op, Style.RESET_ALL)
+        return kept
+
+    def requeue(self, redis_ops, mongo_ops):
+        """
+        put failed writes back in front of the buffer
+        """
+        with self.lock:
+            self.redis_ops = redis_ops + self.redis_ops
+            for key, ops in mongo_ops.items():
+                self.mongo_ops[key] = ops + self.mongo_ops[key]
+            self.retry_later(len(redis_ops) + sum(len(x) for x in mongo_ops.values()))
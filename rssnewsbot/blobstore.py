@@ -0,0 +1,244 @@
+"""
+Compressed raw html storage.
+
+Raw pages are compressed with zstd (using a dictionary trained on finance
+news pages when HTML_DICT_PATH is set, zlib if zstandard is not installed)
+and stored out of line, keyed by the news uuid, either in GridFS or in a local
+directory. The news document only keeps a reference:
+
+    "html": {"store": "gridfs", "ref": <uuid>, "codec": "zstd", "dict": <zstd dictionary id>, "size": <raw size>, "stored_size": <compressed size>}
+
+"dict" is the id of the dictionary the page was compressed with (0 for
+none), read back from the zstd frame, so pages stay readable after the
+dictionary is retrained as long as the older dictionaries are kept listed in
+HTML_OLD_DICT_PATHS.
+
+Train a dictionary or move the html of existing news documents out of line with
+
+    python -m rssnewsbot.blobstore train --mongodb-uri mongodb://localhost:27017 -o html.dict
+    python -m rssnewsbot.blobstore migrate --mongodb-uri mongodb://localhost:27017
+"""
+import os
+import zlib
+import logging
+import tempfile
+from argparse import ArgumentParser
+import gridfs
+from gridfs.errors import FileExists
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 6
+
+_dicts = {}
+
+
+def load_dict(dict_path):
+    """
+    zstd dictionary stored at dict_path, loaded once per process
+    """
+    if not dict_path:
+        return None
+    if dict_path not in _dicts:
+        with open(dict_path, "rb") as f:
+            _dicts[dict_path] = zstandard.ZstdCompressionDict(f.read())
+    return _dicts[dict_path]
+
+
+def compress(page, dict_path=None):
+    """
+    returns (codec, compressed page)
+    """
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=load_dict(dict_path)).compress(page)
+    return "zlib", zlib.compress(page, ZLIB_LEVEL)
+
+
+def frame_dict_id(blob):
+    """
+    id of the zstd dictionary a compressed blob needs, 0 for none
+    """
+    return zstandard.get_frame_parameters(blob).dict_id
+
+
+def decompress(codec, blob, dict_path=None):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor(dict_data=load_dict(dict_path)).decompress(blob)
+    elif codec == "zlib":
+        return zlib.decompress(blob)
+    raise ValueError("unknown codec %s" % codec)
+
+
+def train_dict(samples, size=112640):
+    """
+    train a zstd dictionary on a list of raw pages
+    """
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+class GridFSBlobStore(object):
+    name = "gridfs"
+
+    def __init__(self, db, collection="html"):
+        self.fs = gridfs.GridFS(db, collection=collection)
+
+    def put(self, key, blob):
+        try:
+            self.fs.put(blob, _id=key)
+        except FileExists:
+            pass
+
+    def get(self, key):
+        return self.fs.get(key).read()
+
+    def delete(self, key):
+        self.fs.delete(key)
+
+
+class FileBlobStore(object):
+    """
+    blobs stored as files under root/<first 2 chars of key>/<key>
+    """
+    name = "file"
+
+    def __init__(self, root, name=None):
+        self.root = root
+        if name is not None:
+            self.name = name
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, key, blob):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:         # created concurrently
+                pass
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.rename(tmp, path)
+
+    def get(self, key):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+class HtmlStore(object):
+    def __init__(self, backend, dict_path=None, old_dict_paths=()):
+        self.backend = backend
+        self.dict_path = dict_path
+        self.dict_paths = {}                # zstd dictionary id -> path, to decompress
+        for path in [dict_path] + list(old_dict_paths):
+            if path:
+                self.dict_paths.setdefault(load_dict(path).dict_id(), path)
+
+    def put(self, key, codec, blob, size):
+        """
+        store an already compressed page, returns the reference kept in the news document
+        """
+        self.backend.put(key, blob)
+        html = {"store": self.backend.name, "ref": key, "codec": codec, "size": size, "stored_size": len(blob)}
+        if codec == "zstd":
+            html["dict"] = frame_dict_id(blob)
+        return html
+
+    def put_page(self, key, page):
+        codec, blob = compress(page, self.dict_path)
+        return self.put(key, codec, blob, len(page))
+
+    def get(self, html):
+        """
+        raw page of the "html" reference of a news document, decompressed with
+        the dictionary recorded in it (references without one use the frame's)
+        """
+        blob = self.backend.get(html["ref"])
+        dict_path = None
+        if html["codec"] == "zstd":
+            dict_id = html.get("dict")
+            if dict_id is None:
+                dict_id = frame_dict_id(blob)
+            if dict_id:
+                dict_path = self.dict_paths.get(dict_id)
+                if dict_path is None:
+                    raise ValueError("unknown html dictionary %s" % dict_id)
+        return decompress(html["codec"], blob, dict_path)
+
+    def delete(self, html):
+        self.backend.delete(html["ref"])
+
+
+def open_store(kind, mongodb_client=None, path=None, dict_path=None, name=None, old_dict_paths=()):
+    """
+    html store of the given kind, name is the "store" recorded in the references
+    of a file store when it differs from "file" (e.g. "archive"); pages are
+    compressed with dict_path and read with it or any of old_dict_paths
+    """
+    if kind == "gridfs":
+        backend = GridFSBlobStore(mongodb_client.rssnews)
+    elif kind == "file":
+        backend = FileBlobStore(path, name)
+    else:
+        raise ValueError("unknown html store %s" % kind)
+    return HtmlStore(backend, dict_path=dict_path, old_dict_paths=old_dict_paths)
+
+
+if __name__ == "__main__":
+    import pymongo as pm
+    from .storage import NewsStore
+    ap = ArgumentParser(description="train the html dictionary or move inline html out of the news documents")
+    ap.add_argument("command", choices=["train", "migrate"])
+    ap.add_argument("--mongodb-uri", type=str, default="mongodb://localhost:27017")
+    ap.add_argument("--store", choices=["gridfs", "file"], default="gridfs")
+    ap.add_argument("--store-path", type=str, default="html")
+    ap.add_argument("--dict", type=str, default=None, help="zstd dictionary used to compress")
+    ap.add_argument("--old-dict", type=str, action="append", default=[], help="older zstd dictionary still read")
+    ap.add_argument("--samples", type=int, default=2000, help="number of pages to train on")
+    ap.add_argument("-o", "--output", type=str, default="html.dict")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    mc = pm.MongoClient(host=args.mongodb_uri)
+    buckets = [mc.rssnews[x] for x in NewsStore(mc.rssnews).buckets()]
+    if args.command == "train":
+        store = open_store(args.store, mc, args.store_path, args.dict, old_dict_paths=args.old_dict)
+        samples = []
+        for news in reversed(buckets):
+            if len(samples) >= args.samples:
+                break
+            with news.find({}, {"compressed_html": True, "html": True}).sort("_id", -1).limit(args.samples - len(samples)) as cursor:
+                for doc in cursor:
+                    if doc.get("compressed_html"):
+                        samples.append(doc["compressed_html"])
+                    elif doc.get("html"):
+                        samples.append(store.get(doc["html"]))
+        logging.info("training dictionary on %d pages", len(samples))
+        with open(args.output, "wb") as f:
+            f.write(train_dict(samples))
+    elif args.command == "migrate":
+        store = open_store(args.store, mc, args.store_path, args.dict, old_dict_paths=args.old_dict)
+        nb_moved = 0
+        for news in buckets:
+            with news.find({"compressed_html": {"$exists": True}}, {"uuid": True, "compressed_html": True}) as cursor:
+                for doc in cursor:
+                    html = store.put_page(doc["uuid"], doc["compressed_html"])
+                    news.update_one({"_id": doc["_id"]}, {"$set": {"html": html}, "$unset": {"compressed_html": ""}})
+                    nb_moved += 1
+        logging.info("moved the html of %d news out of line", nb_moved)
+    mc.close()
@@ -0,0 +1,97 @@
+"""
+Feed ownership for multiple feed_updater nodes.
+
+Every node sends a heartbeat to the redis sorted set feed_updater:nodes
+(member = node id, score = time of the last heartbeat); nodes silent for
+longer than timeout seconds are considered gone. The live nodes are placed on
+a consistent hash ring with vnodes virtual nodes each, and a feed is polled by
+the node its _id hashes to. When a node joins or leaves only the feeds of its
+ring segments move.
+"""
+import os
+import socket
+import bisect
+import logging
+import threading
+from time import time
+import xxhash
+
+NODES_KEY = "feed_updater:nodes"
+
+
+def hash64(s):
+    if not isinstance(s, bytes):
+        s = s.encode("utf-8")
+    return xxhash.xxh64(s).intdigest()
+
+
+class ClusterMembership(object):
+    def __init__(self, rc, node_id=None, interval=5, timeout=20, vnodes=64):
+        self.rc = rc
+        self.node_id = node_id or "{0}:{1}".format(socket.gethostname(), os.getpid())
+        self.interval = interval
+        self.timeout = timeout
+        self.vnodes = vnodes
+        self.lock = threading.Lock()
+        self.nodes = ()
+        self.ring = []
+        self.points = []
+        self.refreshed = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def beat(self):
+        now = time()
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.zadd(NODES_KEY, {self.node_id: now})
+        pipe.zremrangebyscore(NODES_KEY, "-inf", now - self.timeout)
+        pipe.execute()
+
+    def refresh(self):
+        """
+        reload the live nodes, returns True if the ring changed
+        """
+        nodes = self.rc.zrangebyscore(NODES_KEY, time() - self.timeout, "+inf")
+        nodes = tuple(sorted(x.decode("utf-8") if isinstance(x, bytes) and not isinstance(x, str) else x for x in nodes))
+        with self.lock:
+            self.refreshed = time()
+            if nodes == self.nodes:
+                return False
+            ring = sorted((hash64("{0}#{1}".format(node, i)), node) for node in nodes for i in range(self.vnodes))
+            self.nodes = nodes
+            self.ring = ring
+            self.points = [x[0] for x in ring]
+        logging.info("cluster changed, %d nodes: %s", len(nodes), ", ".join(nodes))
+        return True
+
+    def owner(self, key):
+        if time() - self.refreshed > self.interval:
+            self.refresh()
+        with self.lock:
+            if not self.ring:
+                return self.node_id
+            i = bisect.bisect(self.points, hash64(key)) % len(self.ring)
+            return self.ring[i][1]
+
+    def owns(self, key):
+        return self.owner(key) == self.node_id
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.beat()
+                self.refresh()
+            except Exception:
+                logging.exception("cluster heartbeat failed")
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.beat()
+        self.refresh()
+        self.thread = threading.Thread(target=self.run, name="cluster-heartbeat")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def leave(self):
+        self.stopped.set()
+        self.rc.zrem(NODES_KEY, self.node_id)
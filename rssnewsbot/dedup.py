@@ -0,0 +1,373 @@
+"""
+Duplicate filter for rss feed items.
+
+Known item uuids are kept in a scalable bloom filter stored as redis bitmaps
+(bloom:0, bloom:1, ... each slice twice as large and with half the error
+rate of the previous one, bookkept in the bloom:meta hash), which costs a few
+bytes per item instead of one redis set per uuid.
+
+Recently added items additionally keep an exact, expiring set of their symbols
+(recent:<uuid>). A bloom hit on an item that is no longer recent is only a
+possible hit and is confirmed against the stored news (storage.NewsStore).
+
+The check and the insertion run as one server side lua script, so concurrent
+feed workers need no lock around it.
+
+The per-uuid symbol sets of older versions (one redis set per uuid) are
+moved into the bloom filter and deleted by migrate_legacy(), run by the feed
+updater when it warms up the filter; until it has completed once (flag
+bloom:legacy_migrated) check_and_add() consults the legacy set of a uuid
+first, so the items they know are not taken as new meanwhile.
+
+The feed entry links (link:<hash of the link>) go through the same filter:
+seen_link() tells, before a redirect link is resolved, whether its entry was
+already handled for its symbols, mark_link() records it once handled.
+"""
+import logging
+from datetime import timedelta
+import xxhash
+from bson import ObjectId
+from .metrics import DEDUP_CHECKS, REDIS_SECONDS, MONGO_SECONDS
+
+NEW = "new"
+NEW_SYMBOL = "new symbol"
+SEEN = "seen"
+MAYBE = "maybe"
+
+BLOOM_PREFIX = "bloom"
+RECENT_PREFIX = "recent:"
+LINK_PREFIX = "link:"
+
+# bloom(prefix, h1, h2, capacity, error_rate, growth, tightening) returns 1 if
+# the item was (possibly) already in the filter, otherwise adds it and returns 0
+BLOOM = """
+local function slice_params(s, capacity, error_rate, growth, tightening)
+    local n = math.floor(capacity * growth ^ s)
+    local k = math.ceil(-math.log(error_rate * tightening ^ s) / math.log(2))
+    local m = math.ceil(n * k / math.log(2))
+    return n, k, m
+end
+
+local function bloom(prefix, h1, h2, capacity, error_rate, growth, tightening)
+    local meta = prefix .. ':meta'
+    local slices = tonumber(redis.call('HGET', meta, 'slices') or 0)
+    for s = 0, slices - 1 do
+        local n, k, m = slice_params(s, capacity, error_rate, growth, tightening)
+        local hit = true
+        for i = 0, k - 1 do
+            if redis.call('GETBIT', prefix .. ':' .. s, (h1 + i * h2) % m) == 0 then
+                hit = false
+                break
+            end
+        end
+        if hit then
+            return 1
+        end
+    end
+    local s = slices - 1
+    if s < 0 or tonumber(redis.call('HGET', meta, 'count:' .. s) or 0) >= slice_params(s, capacity, error_rate, growth, tightening) then
+        s = slices
+        redis.call('HSET', meta, 'slices', slices + 1)
+    end
+    local n, k, m = slice_params(s, capacity, error_rate, growth, tightening)
+    for i = 0, k - 1 do
+        redis.call('SETBIT', prefix .. ':' .. s, (h1 + i * h2) % m, 1)
+    end
+    redis.call('HINCRBY', meta, 'count:' .. s, 1)
+    return 0
+end
+"""
+
+# KEYS: recent set of the uuid
+# ARGV: symbol, ttl of the recent set, bloom prefix, h1, h2, capacity, error_rate, growth, tightening
+# returns 1 if the uuid is new, 2 if only the symbol is new, 0 if both were seen, 3 if the uuid may have been seen
+CHECK_AND_ADD = BLOOM + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    local added = redis.call('SADD', KEYS[1], ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    if added == 1 then
+        return 2
+    end
+    return 0
+end
+if bloom(ARGV[3], tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7]), tonumber(ARGV[8]), tonumber(ARGV[9])) == 1 then
+    return 3
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: recent set of the uuid
+# ARGV: symbol, ttl of the recent set, status found in the stored news (1 or 2 or 0), symbols of the stored news...
+# records the resolution of a possible hit only if no other worker created the
+# recent set meanwhile (like SET NX), whose check then wins; returns the status
+RESOLVE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    local added = redis.call('SADD', KEYS[1], ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    if added == 1 then
+        return 2
+    end
+    return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return tonumber(ARGV[3])
+"""
+
+# ARGV: bloom prefix, h1, h2, capacity, error_rate, growth, tightening
+ADD = BLOOM + """
+return bloom(ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7]))
+"""
+
+# KEYS: recent set of the key
+# ARGV: bloom prefix, h1, h2, capacity, error_rate, growth, tightening, symbols...
+# read only: returns 0 if the key was seen with all the symbols, 1 if it was not
+# (or not with all of them), 3 if it may have been seen
+CHECK = """
+local function slice_params(s, capacity, error_rate, growth, tightening)
+    local n = math.floor(capacity * growth ^ s)
+    local k = math.ceil(-math.log(error_rate * tightening ^ s) / math.log(2))
+    local m = math.ceil(n * k / math.log(2))
+    return n, k, m
+end
+
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    for i = 8, #ARGV do
+        if redis.call('SISMEMBER', KEYS[1], ARGV[i]) == 0 then
+            return 1
+        end
+    end
+    return 0
+end
+local prefix, h1, h2 = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local slices = tonumber(redis.call('HGET', prefix .. ':meta', 'slices') or 0)
+for s = 0, slices - 1 do
+    local n, k, m = slice_params(s, tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7]))
+    local hit = true
+    for i = 0, k - 1 do
+        if redis.call('GETBIT', prefix .. ':' .. s, (h1 + i * h2) % m) == 0 then
+            hit = false
+            break
+        end
+    end
+    if hit then
+        return 3
+    end
+end
+return 1
+"""
+
+RESULTS = {0: SEEN, 1: NEW, 2: NEW_SYMBOL, 3: MAYBE}
+CODES = dict((v, k) for k, v in RESULTS.items())
+
+
+def link_key(link):
+    """
+    filter key of a feed entry link, kept apart from the uuids of the urls
+    """
+    if not isinstance(link, bytes):
+        link = link.encode("utf-8")
+    return LINK_PREFIX + xxhash.xxh64(link).hexdigest()
+
+
+def hashes(uuid):
+    """
+    two independent 32 bit hashes of uuid, the bit positions are h1 + i * h2
+    """
+    if not isinstance(uuid, bytes):
+        uuid = uuid.encode("utf-8")
+    h = xxhash.xxh64(uuid).intdigest()
+    return h & 0xffffffff, (h >> 32) | 1
+
+
+class DedupFilter(object):
+    """
+    rc is the redis connection of the filter, news the NewsStore used to
+    confirm possible hits
+    """
+
+    def __init__(self, rc, news, capacity=1000000, error_rate=0.001, growth=2, tightening=0.5,
+                 recent_ttl=3*86400, prefix=BLOOM_PREFIX):
+        self.rc = rc
+        self.news = news
+        self.recent_ttl = recent_ttl
+        self.params = [prefix, capacity, error_rate, growth, tightening]
+        self.check_script = rc.register_script(CHECK_AND_ADD)
+        self.add_script = rc.register_script(ADD)
+        self.seen_script = rc.register_script(CHECK)
+        self.resolve_script = rc.register_script(RESOLVE)
+        self.legacy_migrated = False
+
+    def legacy_pending(self):
+        """
+        whether the legacy per-uuid sets may still exist, until migrate_legacy() completed once
+        """
+        if not self.legacy_migrated:
+            self.legacy_migrated = bool(self.rc.exists(self.params[0] + ":legacy_migrated"))
+        return not self.legacy_migrated
+
+    def check_legacy(self, uuid, symbol):
+        """
+        the status of (uuid, symbol) from the legacy set of uuid, None if it has none;
+        checked before the bloom filter, so a set migrated meanwhile is found there
+        """
+        symbols = self.rc.smembers(uuid)
+        if not symbols:
+            return None
+        symbols = set(x.decode("utf-8") if isinstance(x, bytes) else x for x in symbols)
+        return self.resolve_script(keys=[RECENT_PREFIX + uuid],
+                                   args=[symbol, self.recent_ttl, CODES[SEEN if symbol in symbols else NEW_SYMBOL]] + sorted(symbols))
+
+    def check_and_add(self, uuid, symbol):
+        """
+        atomically mark (uuid, symbol) as seen, returns NEW, NEW_SYMBOL or SEEN
+        """
+        if self.legacy_pending():
+            with REDIS_SECONDS.time(op="dedup"):
+                code = self.check_legacy(uuid, symbol)
+            if code is not None:
+                status = RESULTS[code]
+                DEDUP_CHECKS.inc(result=status)
+                return status
+        h1, h2 = hashes(uuid)
+        args = [symbol, self.recent_ttl, self.params[0], h1, h2] + self.params[1:]
+        with REDIS_SECONDS.time(op="dedup"):
+            status = RESULTS[self.check_script(keys=[RECENT_PREFIX + uuid], args=args)]
+        if status == MAYBE:
+            DEDUP_CHECKS.inc(result=MAYBE)
+            status = self.lookup(uuid, symbol)
+        DEDUP_CHECKS.inc(result=status)
+        return status
+
+    def lookup(self, uuid, symbol):
+        """
+        exact check of a possible hit against the stored news, the result is
+        kept in the recent set of the uuid unless a concurrent check of the same
+        uuid created it first, in which case that check decides
+        """
+        with MONGO_SECONDS.time(op="dedup_lookup"):
+            doc = self.news.find_uuid(uuid, {"symbols": True})
+        if doc is None:
+            logging.debug("bloom filter false positive, uuid=%s", uuid)
+            status = NEW
+            symbols = []
+        else:
+            symbols = doc.get("symbols", [])
+            status = SEEN if symbol in symbols else NEW_SYMBOL
+        with REDIS_SECONDS.time(op="dedup"):
+            return RESULTS[self.resolve_script(keys=[RECENT_PREFIX + uuid],
+                                               args=[symbol, self.recent_ttl, CODES[status]] + list(symbols))]
+
+    def seen_link(self, link, symbols):
+        """
+        whether the feed entry link was already handled for all symbols, without
+        marking it, so an already seen redirect link needs no http round trip; a
+        possible bloom hit is confirmed against the "link" of the stored news
+        """
+        key = link_key(link)
+        h1, h2 = hashes(key)
+        with REDIS_SECONDS.time(op="dedup"):
+            status = RESULTS[self.seen_script(keys=[RECENT_PREFIX + key],
+                                              args=[self.params[0], h1, h2] + self.params[1:] + list(symbols))]
+        if status == MAYBE:
+            with MONGO_SECONDS.time(op="dedup_lookup"):
+                doc = self.news.find_link(link, {"symbols": True})
+            return doc is not None and set(symbols) <= set(doc.get("symbols", []))
+        return status == SEEN
+
+    def mark_link(self, link, symbols):
+        """
+        mark the feed entry link as handled for symbols
+        """
+        key = link_key(link)
+        h1, h2 = hashes(key)
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.sadd(RECENT_PREFIX + key, *symbols)
+        pipe.expire(RECENT_PREFIX + key, self.recent_ttl)
+        self.add_script(args=[self.params[0], h1, h2] + self.params[1:], client=pipe)
+        pipe.execute()
+
+    def add_many(self, uuids):
+        """
+        add a batch of uuids to the bloom filter in one pipeline,
+        returns the number of uuids that were not in the filter yet
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        for uuid in uuids:
+            h1, h2 = hashes(uuid)
+            self.add_script(args=[self.params[0], h1, h2] + self.params[1:], client=pipe)
+        return sum(1 for x in pipe.execute() if x == 0)
+
+    def migrate_legacy(self, batch_size=1000):
+        """
+        move the per-uuid symbol sets of older versions (a set named by the bare
+        8 hex digit uuid) into the bloom filter and delete them, returns the
+        number of sets migrated; their symbols are found in the stored news
+        """
+        nb_moved, batch = 0, []
+        for key in self.rc.scan_iter(match="[0-9a-f]" * 8, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                nb_moved += self.drop_legacy(batch)
+                batch = []
+        if batch:
+            nb_moved += self.drop_legacy(batch)
+        self.rc.set(self.params[0] + ":legacy_migrated", 1)
+        self.legacy_migrated = True
+        return nb_moved
+
+    def drop_legacy(self, keys):
+        self.add_many([x.decode("ascii") if isinstance(x, bytes) else x for x in keys])
+        self.rc.delete(*keys)
+        return len(keys)
+
+    def warm(self, batch_size=1000, margin=600):
+        """
+        stream the uuids of the news stored since the last warm-up into the bloom
+        filter, returns the number of uuids added
+
+        the high-water mark is the last _id added (kept in bloom:warm), the scan
+        restarts margin seconds before it to pick up documents whose client side
+        _id was generated before but written after the mark was saved. The mark
+        only comes from bucket documents: a first warm-up streams the legacy
+        collection without saving it, so an interrupted run starts over.
+        """
+        key = self.params[0] + ":warm"
+        last = self.rc.get(key)
+        since = None
+        if last is not None:
+            since = ObjectId(last.decode("ascii") if isinstance(last, bytes) else last).generation_time
+            since = ObjectId.from_datetime(since - timedelta(seconds=margin))
+        nb_added = 0
+        if since is None:
+            nb_added += self.add_docs(self.news.iter_legacy({"uuid": True}, batch_size), batch_size)
+        docs = self.news.iter_since(since, {"uuid": True}, batch_size, legacy=False)
+        return nb_added + self.add_docs(docs, batch_size, key)
+
+    def add_docs(self, docs, batch_size, mark=None):
+        """
+        add the uuids of news documents in batches, saving the _id of the last
+        one of every batch to the key mark if given
+        """
+        nb_added, batch = 0, []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                nb_added += self.add_many([x["uuid"] for x in batch])
+                if mark is not None:
+                    self.rc.set(mark, str(batch[-1]["_id"]))
+                batch = []
+        if batch:
+            nb_added += self.add_many([x["uuid"] for x in batch])
+            if mark is not None:
+                self.rc.set(mark, str(batch[-1]["_id"]))
+        return nb_added
+
+    def count(self):
+        """
+        approximate number of uuids in the bloom filter
+        """
+        meta = self.rc.hgetall(self.params[0] + ":meta")
+        return sum(int(v) for k, v in meta.items() if k.startswith(b"count:"))
@@ -0,0 +1,110 @@
+"""
+Per-domain politeness for article downloads.
+
+Pending items are spread over one sub queue per host, each with its own token
+bucket, and handed out round robin over the hosts so a burst of links to one
+site does not starve the others. The rate of a host adapts to its responses
+(AIMD): it is halved on 429/503 (and the host is paused for Retry-After),
+reduced when the latency goes over the target and slowly raised otherwise.
+"""
+from time import time
+from collections import deque
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+THROTTLED = (429, 503)
+
+
+def host_of(url):
+    return urlparse(url).netloc.lower()
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.paused_until = 0
+
+    def take(self, now):
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class DomainDispatcher(object):
+    def __init__(self, rate=1.0, burst=2, min_rate=0.05, max_rate=8.0, target_latency=2.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.queues = {}
+        self.buckets = {}
+        self.hosts = deque()        # round robin order of the hosts with queued items
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, url, item):
+        host = host_of(url)
+        if host not in self.queues:
+            self.queues[host] = deque()
+            self.buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+        if not self.queues[host]:
+            self.hosts.append(host)
+        self.queues[host].append(item)
+        self.size += 1
+
+    def pop(self, count, now=None):
+        """
+        up to count items whose host is allowed a request now, one host after the other
+        """
+        now = now or time()
+        items = []
+        idle = 0                    # hosts in a row that could not send
+        while self.hosts and len(items) < count and idle < len(self.hosts):
+            host = self.hosts[0]
+            self.hosts.rotate(-1)
+            if not self.buckets[host].take(now):
+                idle += 1
+                continue
+            idle = 0
+            items.append(self.queues[host].popleft())
+            self.size -= 1
+            if not self.queues[host]:
+                self.hosts.remove(host)
+                del self.queues[host]
+        return items
+
+    def items(self):
+        for queue in self.queues.values():
+            for item in queue:
+                yield item
+
+    def feedback(self, url, status=None, latency=None, retry_after=None):
+        """
+        adapt the rate of the host of url to a response (status None for a failed download)
+        """
+        bucket = self.buckets.get(host_of(url))
+        if bucket is None:
+            return
+        if status in THROTTLED:
+            bucket.rate = max(self.min_rate, bucket.rate / 2.0)
+            if retry_after:
+                bucket.paused_until = time() + retry_after
+        elif status is None:
+            bucket.rate = max(self.min_rate, bucket.rate * 0.75)
+        elif latency is not None and latency > self.target_latency:
+            bucket.rate = max(self.min_rate, bucket.rate * 0.9)
+        else:
+            bucket.rate = min(self.max_rate, bucket.rate + 0.1)
@@ -0,0 +1,124 @@
+"""
+Article content extraction.
+
+The content of a page is the text of the container holding the largest number
+of words in text tags (p, span, ul, td), after removing scripts, styles,
+images, the <head> and footers.
+
+extract_text works directly on the lxml tree: noisy elements are stripped in
+one C level pass and the text tags are visited once. extract_text_soup is the
+original BeautifulSoup implementation, kept as the reference for
+benchmarks/bench_extract.py.
+"""
+import operator
+from collections import defaultdict
+from lxml import etree
+import lxml.html
+
+NOISY_TAGS = ["script", "style", "img", "iframe", "select"]
+TEXT_TAGS = ["p", "span", "ul", "td"]
+FOOTERS = etree.XPath('//footer | //*[@id="footer"] | //*[contains(concat(" ", normalize-space(@class), " "), " footer ")]')
+
+
+def extract_text(page):
+    """
+    extract the main text of an html page (bytes or text), None if there is none
+    """
+    try:
+        root = lxml.html.document_fromstring(page)
+    except (etree.ParserError, ValueError):
+        return None
+
+    # remove noisy tags, comments, processing instructions, <head> and footers, keeping their tails
+    # separated from the preceding text, which they would otherwise be glued to ("a<!-- -->b" is "a b")
+    for e in root.iter(etree.Comment, etree.ProcessingInstruction, "head", *NOISY_TAGS):
+        if e.tail:
+            e.tail = " " + e.tail
+    etree.strip_elements(root, etree.Comment, etree.ProcessingInstruction, "head", *NOISY_TAGS, with_tail=False)
+    for footer in FOOTERS(root):
+        if footer.getparent() is not None:
+            footer.drop_tree()
+
+    # containers of text tags, in document order: container -> [text, word count]
+    containers = {}
+    order = []
+    for text_tag in root.iter(*TEXT_TAGS):
+        parts = list(text_tag.itertext())
+        container = text_tag.getparent()
+        if container not in containers:
+            containers[container] = [[], 0]
+            order.append(container)
+        stats = containers[container]
+        stats[0].append(" ".join(p.strip() for p in parts if p.strip()) + "\n")
+        stats[1] += len("".join(parts).split())
+    if not order:
+        return None
+    # select the container that has biggest word count
+    best = max(order, key=lambda c: containers[c][1])
+    return "".join(containers[best][0]).strip() or None
+
+
+def extract_text_soup(page):
+    """
+    reference implementation of extract_text on top of BeautifulSoup
+    """
+    from bs4 import BeautifulSoup, Comment, Doctype, CData, ProcessingInstruction, Declaration, Tag
+
+    noisy_elms = [Comment, Doctype, CData, ProcessingInstruction, Declaration]
+
+    def remove_empty_tags(soup):
+        if isinstance(soup, Tag):
+            if len(soup.contents) > 0:
+                for child in soup.contents:
+                    if isinstance(child, Tag):
+                        remove_empty_tags(child)
+            if len(soup.contents) == 0:
+                soup.extract()
+        return soup
+
+    def prune(soup):
+        # remove noisy tags
+        for e in soup(NOISY_TAGS):
+            e.extract()
+
+        # remove noisy elements
+        for noisy_elm in noisy_elms:
+            elms = soup.findAll(e=lambda e: isinstance(e, noisy_elm))
+            for e in elms:
+                e.extract()
+
+        # remove <head>
+        if soup.head:
+            soup.head.extract()
+
+        # remove empty tags
+        soup = remove_empty_tags(soup)
+
+        # remove footer
+        if soup.footer:
+            soup.footer.extract()
+        for div in soup.select("#footer"):
+            div.extract()
+        for div in soup.select(".footer"):
+            div.extract()
+        return soup
+
+    # Get containers that contain text tags,
+    # build two dicts of them:
+    # k: container, v: text
+    # k: container, v: word count
+    soup = prune(BeautifulSoup(page, 'lxml'))
+    target_tags = soup.find_all(TEXT_TAGS)
+    container_text = defaultdict(lambda: '')
+    container_wcount = defaultdict(int)
+    for text_tag in target_tags:
+        text = text_tag.get_text()
+        wcount = len(text.split())
+        container_text[text_tag.parent] += text_tag.get_text(separator=' ', strip=True) + '\n'
+        container_wcount[text_tag.parent] += wcount
+    if len(container_wcount) > 0:
+        # Select the container that has biggest word count
+        content_container = max(container_wcount.items(), key=operator.itemgetter(1))[0]
+        return container_text[content_container]
+    else:
+        return None
@@ -0,0 +1,148 @@
+"""
+Fan-out of news events to redis pub/sub subscribers.
+
+Events are published on the channel of their symbol (news_<symbol>) and on
+the channels of the indexes the symbol belongs to (index_<index>, e.g.
+index_DJI and index_NDX for MSFT), so a watcher of a whole index needs one subscription, and
+"PSUBSCRIBE news_*" sees every symbol. Events are buffered for at most
+max_delay seconds and every message is a msgpack packed list of the events
+of one channel:
+
+    {"type": "news", "symbol": "AAPL", "item": {"uuid": ..., "title": ..., ...}}
+    {"type": "symbol_added", "symbol": "AAPL", "uuid": ...}
+    {"type": "stored", "symbol": "AAPL", "item": {"uuid": ..., "parsed": ..., "tags": ..., ...}}
+
+"news" and "symbol_added" come from the feed updater, "stored" from the
+article spider once the article is downloaded and extracted.
+
+The last history events of every symbol are also kept in the redis list
+news_history:<symbol>, newest first, for subscribers to catch up with
+replay() after (re)connecting.
+
+Like the write batcher, a batch whose pipeline fails is put back in the
+buffer and published again after retry_delay seconds; events that cannot be
+packed are logged and dropped.
+"""
+import logging
+from collections import defaultdict
+import msgpack
+from colorama import Back, Style
+from .batching import BufferedFlusher
+from .metrics import REDIS_SECONDS
+
+SYMBOL_PREFIX = "news_"
+INDEX_PREFIX = "index_"
+HISTORY_PREFIX = "news_history:"
+
+
+def symbol_channel(symbol):
+    return SYMBOL_PREFIX + symbol
+
+
+def index_channel(index):
+    return INDEX_PREFIX + index
+
+
+def index_map(feeds):
+    """
+    symbol -> sorted indexes of the symbol from feed documents ("indexes", or "index" of older documents)
+    """
+    indexes = defaultdict(set)
+    for feed in feeds:
+        indexes[feed["symbol"]].update(feed.get("indexes") or ([feed["index"]] if feed.get("index") else []))
+    return dict((k, sorted(v)) for k, v in indexes.items() if v)
+
+
+def unpack(message):
+    """
+    the events of a pub/sub message
+    """
+    return msgpack.unpackb(message)
+
+
+def replay(rc, symbol, count=100):
+    """
+    the last count events of symbol, oldest first
+    """
+    return [msgpack.unpackb(x) for x in reversed(rc.lrange(HISTORY_PREFIX + symbol, 0, count - 1))]
+
+
+class FanOut(BufferedFlusher):
+    name = "fanout"
+
+    def __init__(self, rc, indexes=None, max_size=100, max_delay=0.05, history=200, retry_delay=5.0):
+        self.rc = rc
+        self.indexes = indexes or {}        # symbol -> indexes
+        self.history = history
+        super(FanOut, self).__init__(max_size, max_delay, retry_delay)
+
+    def reset(self):
+        self.events = defaultdict(list)     # symbol -> events
+
+    def swap(self):
+        events = self.events
+        self.reset()
+        return events
+
+    def news(self, symbol, item):
+        self.add_event(symbol, {"type": "news", "symbol": symbol, "item": item})
+
+    def symbol_added(self, uuid, symbol):
+        self.add_event(symbol, {"type": "symbol_added", "symbol": symbol, "uuid": uuid})
+
+    def stored(self, symbol, item):
+        self.add_event(symbol, {"type": "stored", "symbol": symbol, "item": item})
+
+    def add_event(self, symbol, event):
+        self.add(lambda: self.events[symbol].append(event))
+
+    def write(self, events):
+        try:
+            self.publish(events)
+        except Exception:
+            logging.exception("publishing news events failed")
+            events = self.packable(events)
+            logging.warning("%d news events kept for retry", sum(len(x) for x in events.values()))
+            self.requeue(events)
+
+    @staticmethod
+    def packable(events):
+        """
+        the events that msgpack can pack, the others are logged and dropped
+        """
+        kept = {}
+        for symbol, symbol_events in events.items():
+            for event in symbol_events:
+                try:
+                    msgpack.packb(event)
+                except Exception:
+                    logging.error("%sdropping a news event that cannot be packed: %r%s", Back.RED, event, Style.RESET_ALL)
+                    continue
+                kept.setdefault(symbol, []).append(event)
+        return kept
+
+    def requeue(self, events):
+        """
+        put the events of a failed batch back in front of the buffer
+        """
+        with self.lock:
+            for symbol, symbol_events in events.items():
+                self.events[symbol] = symbol_events + self.events[symbol]
+            self.retry_later(sum(len(x) for x in events.values()))
+
+    def publish(self, events):
+        channels = defaultdict(list)
+        pipe = self.rc.pipeline(transaction=False)
+        for symbol, symbol_events in events.items():
+            channels[symbol_channel(symbol)].extend(symbol_events)
+            for index in self.indexes.get(symbol, ()):
+                channels[index_channel(index)].extend(symbol_events)
+            if self.history:
+                key = HISTORY_PREFIX + symbol
+                pipe.lpush(key, *[msgpack.packb(x) for x in symbol_events])
+                pipe.ltrim(key, 0, self.history - 1)
+        for channel, channel_events in channels.items():
+            pipe.publish(channel, msgpack.packb(channel_events))
+        with REDIS_SECONDS.time(op="fanout"):
+            pipe.execute()
+        logging.debug("published %d events on %d channels", sum(len(x) for x in events.values()), len(channels))
@@ -0,0 +1,44 @@
+"""
+Conditional GET support for rss feeds.
+
+The ETag and Last-Modified validators of every feed are stored in its
+document of the rssnews.feed collection (fields "etag" and "last_modified"),
+next to "updated" and "updated_timestamps", and sent back on the next poll
+so an unchanged feed is answered with a bodyless 304. The validators of a
+response are only stored once all its entries were handled, a feed with
+entries left to retry is fetched in full again.
+"""
+
+NOT_MODIFIED = 304
+
+
+def _str(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode("latin-1")
+    return value
+
+
+def request_headers(feed):
+    """
+    build If-None-Match / If-Modified-Since headers from the validators stored in feed
+    """
+    headers = {}
+    if feed.get("etag"):
+        headers["If-None-Match"] = feed["etag"]
+    if feed.get("last_modified"):
+        headers["If-Modified-Since"] = feed["last_modified"]
+    return headers
+
+
+def changed_validators(feed, etag, last_modified):
+    """
+    return the validators of a response that differ from the ones stored in feed,
+    as a dict ready to be $set into the feed document
+    """
+    changed = {}
+    etag, last_modified = _str(etag), _str(last_modified)
+    if etag and etag != feed.get("etag"):
+        changed["etag"] = etag
+    if last_modified and last_modified != feed.get("last_modified"):
+        changed["last_modified"] = last_modified
+    return changed
@@ -0,0 +1,94 @@
+"""
+Multi-symbol feeds.
+
+The yahoo headline feed accepts several comma separated symbols (s=A,B,C),
+so the feeds of the rssnews.feed collection can be polled in groups with
+one request each instead of one per symbol. A group task looks like a feed
+document: its "_id" is the comma separated symbols, "symbols" and "members"
+(the feed documents) list its symbols, and the state of the group feed
+(validators, watermark, updated/updated_timestamps) is kept in the
+rssnews.feed_group collection. The per-symbol updated/updated_timestamps
+stay in the feed documents of the members.
+
+The entries of a group feed do not say which symbol they were returned for,
+they are mapped back by SymbolMatcher from the tickers and the company name
+aliases (ALIASES.txt, see tagger) in their titles. An entry matching none of
+them (e.g. a general market headline) goes to every symbol of the group, as
+the per-symbol feeds of all of them would have returned it.
+"""
+import re
+from .tagger import load_aliases
+try:
+    from urlparse import urlparse, urlunparse, parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+
+def group_url(url, symbols):
+    """
+    url of the feed of one symbol with its s= parameter set to all symbols
+    """
+    parts = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != "s"] + [("s", ",".join(symbols))]
+    return urlunparse(parts._replace(query=urlencode(query).replace("%2C", ",")))
+
+
+class SymbolMatcher(object):
+    """
+    maps an entry title to the symbols of a group it mentions
+    """
+
+    def __init__(self, members, aliases=None):
+        aliases = aliases or {}
+        self.symbols = [m["symbol"] for m in members]
+        self.patterns = []
+        for m in members:
+            names = [re.escape(m["symbol"])]
+            base = m["symbol"].split(".")[0]
+            if base != m["symbol"] and len(base) > 1:
+                names.append(re.escape(base))
+            ticker = re.compile(r"(?<![\w.])\$?(?:{0})(?!\w)".format("|".join(names)))
+            names = m.get("aliases") or aliases.get(m["symbol"])
+            keyword = re.compile(r"(?<!\w)(?:{0})(?!\w)".format("|".join(re.escape(x) for x in names))) if names else None
+            self.patterns.append((m["symbol"], ticker, keyword))
+
+    def match(self, title):
+        """
+        the symbols mentioned in title, all the symbols of the group if none
+        """
+        found = []
+        if title:
+            for symbol, ticker, keyword in self.patterns:
+                if ticker.search(title) or (keyword is not None and keyword.search(title)):
+                    found.append(symbol)
+        return found or list(self.symbols)
+
+
+def make_groups(feeds, size, collection, aliases=None):
+    """
+    group the feed documents by index and symbol into tasks of up to size symbols,
+    with the group state stored in collection; aliases are the company name
+    aliases of the symbols, ALIASES.txt by default
+    """
+    if aliases is None:
+        aliases = load_aliases()
+    feeds = sorted(feeds, key=lambda x: ((x.get("indexes") or [x.get("index") or ""])[0], x["symbol"]))
+    groups = []
+    for i in range(0, len(feeds), size):
+        members = feeds[i:i + size]
+        symbols = [m["symbol"] for m in members]
+        groups.append({
+            "_id": ",".join(symbols),
+            "symbol": ",".join(symbols),
+            "symbols": symbols,
+            "members": members,
+            "matcher": SymbolMatcher(members, aliases),
+            "url": group_url(members[0]["url"], symbols),
+            "updated": 0,
+        })
+    states = dict((x["_id"], x) for x in collection.find({"_id": {"$in": [g["_id"] for g in groups]}}))
+    for tid, group in enumerate(groups):
+        group.update(states.get(group["_id"], {}))
+        group["tid"] = tid
+    return groups
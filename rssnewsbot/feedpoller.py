@@ -0,0 +1,115 @@
+"""
+Asynchronous rss feed poller.
+
+All feeds are downloaded from a single twisted reactor sharing one persistent
+connection pool. The number of requests in flight is bounded globally and per
+host, downloaded bodies are handed to a thread pool where the (blocking)
+redis/mongodb part of the feed processing runs.
+"""
+import logging
+from time import time
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+from colorama import Back, Style
+from twisted.internet import reactor, defer, threads
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.web.client import Agent, ProxyAgent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+from .feedcache import request_headers
+from .metrics import FEED_FETCH_SECONDS, FEED_RESPONSES
+
+USER_AGENT = b"Mozilla/5.0 (compatible; rssnewsbot)"
+
+
+class FeedPoller(object):
+    """
+    poll rss feeds concurrently on the twisted reactor
+
+    handler is called in the reactor thread pool as handler(task, status, headers, body)
+    and should return the number of new items found in the feed.
+    """
+
+    def __init__(self, handler, concurrency=100, per_host=8, nb_threads=10, proxy=None, timeout=30):
+        self.handler = handler
+        self.timeout = timeout
+        self.per_host = per_host
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = per_host
+        self.pool.cachedConnectionTimeout = 240
+        if proxy:
+            host, port = proxy.split(":")
+            endpoint = TCP4ClientEndpoint(reactor, host, int(port), timeout=timeout)
+            self.agent = ProxyAgent(endpoint, reactor, pool=self.pool)
+        else:
+            self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.slots = defer.DeferredSemaphore(concurrency)
+        self.host_slots = {}
+        reactor.suggestThreadPoolSize(nb_threads)
+
+    def host_slot(self, url):
+        host = urlparse(url).netloc
+        if host not in self.host_slots:
+            self.host_slots[host] = defer.DeferredSemaphore(self.per_host)
+        return self.host_slots[host]
+
+    def request_headers(self, task):
+        """
+        headers sent along with the feed request, including the conditional GET validators
+        """
+        headers = Headers({b"User-Agent": [USER_AGENT]})
+        for k, v in request_headers(task).items():
+            headers.addRawHeader(k.encode("ascii"), v.encode("latin-1"))
+        return headers
+
+    @defer.inlineCallbacks
+    def fetch(self, task):
+        """
+        download a single feed, returns (status, headers, body)
+        """
+        url = task["url"]
+        host_slot = self.host_slot(url)
+        yield host_slot.acquire()       # take the host slot first so a busy host does not hold global slots
+        yield self.slots.acquire()
+        start = time()
+        try:
+            d = self.agent.request(b"GET", url.encode("utf-8"), self.request_headers(task))
+            timeout = reactor.callLater(self.timeout, d.cancel)
+            try:
+                res = yield d
+                body = yield readBody(res)
+            finally:
+                if timeout.active():
+                    timeout.cancel()
+        finally:
+            self.slots.release()
+            host_slot.release()
+        FEED_FETCH_SECONDS.observe(time() - start)
+        FEED_RESPONSES.inc(status=res.code)
+        defer.returnValue((res.code, res.headers, body))
+
+    @defer.inlineCallbacks
+    def poll(self, task):
+        try:
+            status, headers, body = yield self.fetch(task)
+        except Exception as e:
+            logging.warning("%serror loading feed, tid=%03d, _id=%s, sym=%5s, rss_url=%s, error=%r%s", Back.RED, task["tid"], task["_id"], task["symbol"], task["url"], e, Style.RESET_ALL)
+            defer.returnValue(0)
+        try:
+            nb_new = yield threads.deferToThread(self.handler, task, status, headers, body)
+        except Exception:
+            logging.exception("error processing feed, tid=%03d, sym=%5s", task["tid"], task["symbol"])
+            nb_new = 0
+        defer.returnValue(nb_new or 0)
+
+    @defer.inlineCallbacks
+    def poll_all(self, tasks):
+        """
+        poll all tasks concurrently, returns the total number of new items
+        """
+        results = yield defer.gatherResults([self.poll(t) for t in tasks])
+        defer.returnValue(sum(results))
+
+    def close(self):
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,250 @@
+"""
+Metrics of the ingestion pipeline.
+
+Counters, gauges and histograms are kept in process and exposed in the
+prometheus text format on http://<host>:<port>/metrics by start_http_server
+(feed_updater.py --metrics-port, METRICS_PORT for the spiders). All metrics of
+the pipeline are defined at the bottom of this module.
+
+SamplingProfiler is an opt-in cProfile hook which profiles one in every n
+calls and periodically dumps the accumulated stats for pstats/snakeviz.
+"""
+import os
+import random
+import cProfile
+import pstats
+import logging
+import threading
+from time import time
+from functools import wraps
+from contextlib import contextmanager
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics):
+            lines.append("# HELP {0} {1}".format(metric.name, metric.doc))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def format_labels(names, values, extra=()):
+    pairs = ['{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(labels.get(x, "") for x in self.labels)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return ["{0}{1} {2}".format(self.name, format_labels(self.labels, k), v) for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, doc, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts, _, _ = stats = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            stats[1] += 1
+            stats[2] += value
+
+    def timed(self, func):
+        """
+        decorator observing the duration of every call
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time():
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def time(self, **labels):
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, count, total) in self.values.items():
+                for bound, n in zip(self.buckets, counts):
+                    lines.append("{0}_bucket{1} {2}".format(self.name, format_labels(self.labels, key, [("le", bound)]), n))
+                lines.append("{0}_bucket{1} {2}".format(self.name, format_labels(self.labels, key, [("le", "+Inf")]), count))
+                lines.append("{0}_count{1} {2}".format(self.name, format_labels(self.labels, key), count))
+                lines.append("{0}_sum{1} {2}".format(self.name, format_labels(self.labels, key), total))
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port, host="", registry=REGISTRY):
+    """
+    serve the metrics of this process from a daemon thread
+    """
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = HTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+    thread.daemon = True
+    thread.start()
+    logging.info("serving metrics on port %d", port)
+    return server
+
+
+class SamplingProfiler(object):
+    """
+    profile one in every `every` calls, the stats are accumulated and dumped to
+    path.<pid> at most every dump_interval seconds. Only one call is profiled at
+    a time, a sampled call overlapping it runs unprofiled.
+    """
+
+    def __init__(self, every, path, dump_interval=60):
+        self.every = every
+        self.path = path
+        self.dump_interval = dump_interval
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+        self.stats = None
+        self.dumped = time()
+
+    def sample(self):
+        return self.every > 0 and random.randint(1, self.every) == 1
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func, *args, **kwargs)
+        return wrapper
+
+    def run(self, func, *args, **kwargs):
+        if not self.sample() or not self.busy.acquire(False):
+            return func(*args, **kwargs)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                self.add(profile)
+        finally:
+            self.busy.release()
+
+    def add(self, profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            if time() - self.dumped > self.dump_interval:
+                self.write()
+
+    def dump(self):
+        with self.lock:
+            if self.stats is not None:
+                self.write()
+
+    def write(self):
+        self.dumped = time()
+        self.stats.dump_stats("{0}.{1}".format(self.path, os.getpid()))
+
+
+# feed updater
+FEED_FETCH_SECONDS = Histogram("rssnews_feed_fetch_seconds", "time to download a feed")
+FEED_PROCESS_SECONDS = Histogram("rssnews_feed_process_seconds", "time to download (unless polled) and process a feed")
+FEED_PARSE_SECONDS = Histogram("rssnews_feed_parse_seconds", "time to parse a feed")
+FEED_RESPONSES = Counter("rssnews_feed_responses_total", "feed responses by http status", ["status"])
+FEED_NEW_ITEMS = Counter("rssnews_feed_new_items_total", "new items and new symbols of existing items found in feeds")
+CYCLE_NEW_ITEMS = Gauge("rssnews_cycle_new_items", "new items found in the last polling cycle")
+DEDUP_CHECKS = Counter("rssnews_dedup_checks_total", "dedup filter checks by result", ["result"])
+REDIS_SECONDS = Histogram("rssnews_redis_seconds", "latency of redis calls", ["op"])
+MONGO_SECONDS = Histogram("rssnews_mongo_seconds", "latency of mongodb calls", ["op"])
+
+# article spider
+PENDING_DEPTH = Gauge("rssnews_pending_depth", "items in the pending stream")
+PENDING_AGE = Gauge("rssnews_pending_age_seconds", "age of the oldest item in the pending stream")
+ARTICLE_DOWNLOAD_SECONDS = Histogram("rssnews_article_download_seconds", "time to download an article")
+EXTRACTION_SECONDS = Histogram("rssnews_extraction_seconds", "time to extract the content of an article")
+PUBLISH_TO_STORED_SECONDS = Histogram("rssnews_publish_to_stored_seconds", "lag between the publication and the storage of an article")
+NEAR_DUPLICATES = Counter("rssnews_near_duplicates_total", "articles linked to a near duplicate instead of stored")
+ARTICLES_STORED = Counter("rssnews_articles_stored_total", "articles stored, by whether content was extracted or the article is a near duplicate", ["content"])
+
+# news api
+API_REQUEST_SECONDS = Histogram("rssnews_api_request_seconds", "time to answer a news api request", ["endpoint"])
+API_READS = Counter("rssnews_api_reads_total", "news api reads by source (memory, not_modified, history)", ["source"])
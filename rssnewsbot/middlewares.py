@@ -6,6 +6,7 @@
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
 # from scrapy import signals
+from .metrics import ARTICLE_DOWNLOAD_SECONDS
 
 
 # class RssnewsbotSpiderMiddleware(object):
@@ -54,3 +55,25 @@
 
 #     def spider_opened(self, spider):
 #         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class DomainFeedbackMiddleware(object):
+    """
+    Report the status and latency of every download to the spider's
+    DomainDispatcher, which adapts the request rate of the host.
+    """
+
+    def process_response(self, request, response, spider):
+        if "download_latency" in request.meta:
+            ARTICLE_DOWNLOAD_SECONDS.observe(request.meta["download_latency"])
+        dispatcher = getattr(spider, "dispatcher", None)
+        if dispatcher is not None:
+            retry_after = response.headers.get("Retry-After")
+            retry_after = int(retry_after) if retry_after and retry_after.isdigit() else None
+            dispatcher.feedback(request.url, response.status, request.meta.get("download_latency"), retry_after)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        dispatcher = getattr(spider, "dispatcher", None)
+        if dispatcher is not None:
+            dispatcher.feedback(request.url)
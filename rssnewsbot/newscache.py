@@ -0,0 +1,125 @@
+"""
+In-memory cache of the latest news of every symbol.
+
+Every symbol keeps a ring buffer of its last size items, newest first, fed
+with the events of the fan-out channels (see fanout.py): "news" adds an
+item, "symbol_added" adds an already known item to another symbol and
+"stored" completes an item with what the article spider found (parsed time,
+tags, duplicate_of) and adds it to the symbols it was tagged with.
+
+follow() subscribes to news_* and then replays the news_history:<symbol>
+lists, so no event is lost between the two; items are deduplicated by uuid.
+A feed symbol seen neither in the history nor since is loaded once from the
+store (its latest stored items), after that reads never leave the process.
+Symbols that are neither feed symbols nor seen in an event are unknown and
+get no buffer, so arbitrary symbols cannot grow the cache.
+Every change of a symbol bumps its version, used as the ETag of its reads.
+"""
+import logging
+import threading
+from collections import deque, OrderedDict
+from .fanout import SYMBOL_PREFIX, unpack, replay
+
+
+class NewsCache(object):
+    def __init__(self, size=100, max_items=100000, store=None, symbols=()):
+        self.size = size
+        self.max_items = max_items
+        self.store = store
+        self.symbols = set(symbols)         # the feed symbols
+        self.lock = threading.Lock()
+        self.buffers = {}                   # symbol -> deque of items, newest first
+        self.versions = {}                  # symbol -> number of changes
+        self.items = OrderedDict()          # uuid -> item, the last max_items items
+
+    def item(self, item):
+        """
+        the cached item of item["uuid"], updated with the fields of item
+        """
+        cached = self.items.pop(item["uuid"], None)
+        if cached is None:
+            cached = dict(item)
+        else:
+            cached.update(item)
+        self.items[item["uuid"]] = cached
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+        return cached
+
+    def push(self, symbol, item):
+        buf = self.buffers.get(symbol)
+        if buf is None:
+            buf = self.buffers[symbol] = deque(maxlen=self.size)
+        if not any(x is item or x["uuid"] == item["uuid"] for x in buf):
+            buf.appendleft(item)
+        self.versions[symbol] = self.versions.get(symbol, 0) + 1
+
+    def apply(self, event):
+        symbol = event["symbol"]
+        with self.lock:
+            if event["type"] in ("news", "stored"):
+                self.push(symbol, self.item(event["item"]))
+            elif event["type"] == "symbol_added":
+                item = self.items.get(event["uuid"])
+                if item is not None:
+                    item["symbols"] = sorted(set(item.get("symbols", [])) | {symbol})
+                    self.push(symbol, item)
+
+    def load(self, symbol):
+        """
+        fill the buffer of a symbol never seen from the store
+        """
+        docs = self.store.latest(symbol, self.size) if self.store is not None else []
+        with self.lock:
+            if symbol not in self.buffers:
+                self.buffers[symbol] = deque((self.item(x) for x in docs), maxlen=self.size)
+                self.versions[symbol] = self.versions.get(symbol, 0) + 1
+
+    def known(self, symbol):
+        return symbol in self.symbols or symbol in self.buffers
+
+    def latest(self, symbol, limit=20):
+        """
+        (version, the last limit items of symbol newest first); limit is at most size,
+        None for an unknown symbol
+        """
+        if symbol not in self.buffers:
+            if symbol not in self.symbols:
+                return None
+            self.load(symbol)
+        with self.lock:
+            buf = self.buffers[symbol]
+            return self.versions[symbol], [dict(x) for x in list(buf)[:limit]]
+
+    def warm(self, rc, symbols):
+        """
+        replay the history lists of symbols, returns the number of events applied
+        """
+        nb_events = 0
+        for symbol in symbols:
+            for event in replay(rc, symbol, self.size):
+                self.apply(event)
+                nb_events += 1
+        return nb_events
+
+    def follow(self, rc, symbols=(), ready=None):
+        """
+        apply the events of all symbol channels until the connection fails,
+        after replaying the history of symbols; sets the ready event once warm
+        """
+        pubsub = rc.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(SYMBOL_PREFIX + "*")
+        try:
+            logging.info("replayed %d news events", self.warm(rc, symbols))
+            if ready is not None:
+                ready.set()
+            for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                for event in unpack(message["data"]):
+                    try:
+                        self.apply(event)
+                    except KeyError:
+                        logging.warning("malformed news event %r", event)
+        finally:
+            pubsub.close()
@@ -0,0 +1,133 @@
+"""
+Reliable queue of the feed items pending download.
+
+Items are msgpack packed entries added to a redis stream (field "item") and
+consumed through a consumer group, so several spider hosts can drain the
+queue in parallel. An item stays pending in the group until it is acked
+after its article has been stored; items left unacked (crashed consumer,
+failed download) are reclaimed once they have been idle for
+backoff * 2 ** (deliveries - 1) seconds, and moved to the dead letter stream
+after max_retries deliveries.
+"""
+import os
+import socket
+import logging
+from time import time
+from redis.exceptions import ResponseError
+from colorama import Back, Style
+
+
+class PendingQueue(object):
+    def __init__(self, rc, stream, group, consumer=None, dead=None, max_retries=5, backoff=60,
+                 reclaim_interval=30, maxlen=None):
+        self.rc = rc
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or "{0}:{1}".format(socket.gethostname(), os.getpid())
+        self.dead = dead or stream + ":dead"
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.reclaim_interval = reclaim_interval
+        self.maxlen = maxlen
+        self.reclaimed = 0
+
+    def create_group(self):
+        try:
+            self.rc.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def push(self, item):
+        """
+        add a packed item, returns its entry id
+        """
+        return self.rc.xadd(self.stream, {"item": item}, maxlen=self.maxlen, approximate=True)
+
+    def pop(self, count):
+        """
+        up to count (entry id, packed item) pairs: reclaimed stale entries first, then new ones
+        """
+        entries = []
+        if time() - self.reclaimed > self.reclaim_interval:
+            self.reclaimed = time()
+            entries = self.reclaim(count)
+        if len(entries) < count:
+            res = self.rc.xreadgroup(self.group, self.consumer, {self.stream: ">"}, count=count - len(entries))
+            for _, messages in res or []:
+                entries.extend(messages)
+        items = []
+        for entry_id, fields in entries:
+            if fields:
+                items.append((entry_id, fields[b"item"]))
+            else:                   # deleted while pending
+                self.ack(entry_id)
+        return items
+
+    def reclaim(self, count):
+        """
+        claim the entries whose backoff has expired, dead letter the ones retried too often
+        """
+        claimed = []
+        pending = self.rc.xpending_range(self.stream, self.group, min="-", max="+", count=max(count, 100),
+                                         idle=int(self.backoff * 1000))
+        for p in pending:
+            deliveries = p["times_delivered"]
+            backoff = self.backoff * 2 ** (deliveries - 1)
+            if p["time_since_delivered"] < backoff * 1000:
+                continue
+            if deliveries >= self.max_retries:
+                self.bury(p["message_id"], deliveries)
+            elif len(claimed) < count:
+                claimed.extend(self.rc.xclaim(self.stream, self.group, self.consumer, int(backoff * 1000), [p["message_id"]]))
+        if claimed:
+            logging.info("reclaimed %d stale pending items", len(claimed))
+        return claimed
+
+    def bury(self, entry_id, deliveries):
+        for _, fields in self.rc.xrange(self.stream, entry_id, entry_id):
+            logging.warning("%sgiving up on pending item %s after %d deliveries%s", Back.RED, entry_id, deliveries, Style.RESET_ALL)
+            self.rc.xadd(self.dead, {"item": fields[b"item"], "id": entry_id, "deliveries": deliveries})
+        self.ack(entry_id)
+
+    def stats(self):
+        """
+        (number of entries, age in seconds of the oldest entry) of the stream,
+        acked entries are deleted so the oldest entry is the oldest item not done yet
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.xlen(self.stream)
+        pipe.xrange(self.stream, count=1)
+        depth, oldest = pipe.execute()
+        age = 0
+        if oldest:
+            entry_id = oldest[0][0]
+            if isinstance(entry_id, bytes):
+                entry_id = entry_id.decode("ascii")
+            age = max(0, time() - int(entry_id.split("-")[0]) / 1000.0)
+        return depth, age
+
+    def touch(self, entry_ids):
+        """
+        reset the idle time of entries still held by this consumer, so they are not reclaimed
+        """
+        if entry_ids:
+            self.rc.xclaim(self.stream, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    def ack(self, entry_id):
+        """
+        mark an entry as done and drop it from the stream
+        """
+        pipe = self.rc.pipeline(transaction=False)
+        pipe.xack(self.stream, self.group, entry_id)
+        pipe.xdel(self.stream, entry_id)
+        pipe.execute()
+
+    def ack_ops(self, entry_id):
+        """
+        the redis commands acking an entry, to be sent by a write batcher once the
+        news document of the entry is stored (WriteBatcher.mongo(..., then=...), or
+        found already stored: on_duplicate=...),
+        so an entry whose document failed to insert stays pending and is reclaimed
+        """
+        return [("xack", (self.stream, self.group, entry_id)), ("xdel", (self.stream, entry_id))]
@@ -4,8 +4,162 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import logging
+from time import time
+from multiprocessing import Pool, cpu_count
+import pymongo as pm
+from twisted.internet import reactor, defer, threads, task
+from twisted.python import failure
+from colorama import Back, Style
+from .extractor import extract_text
+from .blobstore import compress, open_store
+from .metrics import EXTRACTION_SECONDS, NEAR_DUPLICATES, SamplingProfiler
+from .simhash import SimHashIndex, fingerprint
+from . import tagger
 
 
 class RssnewsbotPipeline(object):
     def process_item(self, item, spider):
         return item
+
+
+worker_profiler = None
+
+
+def extract_worker(page, dict_path=None, tagger_path=None, profile_every=0, profile_path=None):
+    """
+    run in the extraction processes, extracts the content, tags it with the symbols
+    it mentions, fingerprints it and compresses the raw page, never raises so the pool
+    callback always fires
+    """
+    global worker_profiler
+    try:
+        codec, blob = compress(page, dict_path)
+        start = time()
+        if profile_every:
+            if worker_profiler is None:
+                worker_profiler = SamplingProfiler(profile_every, profile_path)
+            content = worker_profiler.run(extract_text, page)
+        else:
+            content = extract_text(page)
+        elapsed = time() - start
+        tags, tickers = tagger.load(tagger_path).tag(content) if tagger_path and content else ([], [])
+        return content or None, codec, blob, elapsed, tags, tickers, fingerprint(content), None
+    except Exception as e:
+        return None, None, None, None, [], [], None, repr(e)
+
+
+class ExtractionPipeline(object):
+    """
+    Extract the content of downloaded articles in a pool of worker processes,
+    off the reactor thread, then store them with spider.update_db.
+
+    Items carry the raw page bytes in "compressed_html". The workers also
+    compress the page, which is written to the html store (see blobstore)
+    and replaced by a reference in the item. At most
+    EXTRACTION_MAX_PENDING pages (default CONCURRENT_REQUESTS) are queued for
+    the pool; while items wait here scrapy holds back further downloads.
+    With PROFILE_EVERY set, one in every n extractions is profiled and the
+    stats are dumped to PROFILE_PATH.<pid> by each worker.
+
+    The symbols mentioned in the content are saved as the "tags" of the item,
+    the ones mentioned by ticker are also added to its symbols (see tagger). The tagger is rebuilt when the
+    feed collection changes, checked every TAGGER_REFRESH seconds.
+
+    With NEAR_DUP_DETECTION, an article whose content is within
+    NEAR_DUP_DISTANCE bits (simhash) of an article stored in the last
+    NEAR_DUP_TTL seconds gets "duplicate_of" set to the uuid of that article
+    and is stored without its content and html.
+    """
+
+    def __init__(self, processes, max_pending, settings):
+        self.processes = processes
+        self.slots = defer.DeferredSemaphore(max_pending)
+        self.settings = settings
+        self.dict_path = settings.get("HTML_DICT_PATH")
+        self.profile = (settings.getint("PROFILE_EVERY"), settings.get("PROFILE_PATH"))
+        self.tagger_cache = settings.get("TAGGER_CACHE")
+        self.tagger_path = None
+        self.tagger_refresher = None
+        self.simhash = None
+        self.pool = None
+        self.mc = None
+        self.store = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        processes = settings.getint("EXTRACTION_PROCESSES") or cpu_count()
+        max_pending = settings.getint("EXTRACTION_MAX_PENDING") or settings.getint("CONCURRENT_REQUESTS")
+        return cls(processes, max_pending, settings)
+
+    def open_spider(self, spider):
+        self.pool = Pool(self.processes)
+        self.mc = pm.MongoClient(host=self.settings.get("MONGODB_URI"))
+        self.store = open_store(self.settings.get("HTML_STORE"), self.mc, self.settings.get("HTML_STORE_PATH"), self.dict_path,
+                                old_dict_paths=self.settings.getlist("HTML_OLD_DICT_PATHS"))
+        if self.settings.getbool("NEAR_DUP_DETECTION"):
+            self.simhash = SimHashIndex(spider.rc, max_distance=self.settings.getint("NEAR_DUP_DISTANCE", 3),
+                                        ttl=self.settings.getint("NEAR_DUP_TTL", 7*86400))
+        if self.tagger_cache:
+            self.refresh_tagger()
+            self.tagger_refresher = task.LoopingCall(threads.deferToThread, self.refresh_tagger)
+            self.tagger_refresher.start(self.settings.getfloat("TAGGER_REFRESH", 300), now=False)
+
+    def refresh_tagger(self):
+        try:
+            path = tagger.cached_tagger(tagger.load_pairs(feed=self.mc.rssnews.feed), self.tagger_cache)
+        except Exception:
+            logging.exception("error building the tagger")
+            return
+        if path != self.tagger_path:
+            logging.info("tagging with %s", path)
+            self.tagger_path = path
+
+    def close_spider(self, spider):
+        if self.tagger_refresher is not None and self.tagger_refresher.running:
+            self.tagger_refresher.stop()
+        self.pool.close()
+        self.pool.join()
+        self.mc.close()
+
+    def extract(self, page):
+        d = defer.Deferred()
+        # a worker that dies (e.g. unpicklable result) must still fire d, or its slot is never released
+        self.pool.apply_async(extract_worker, (page, self.dict_path, self.tagger_path) + self.profile,
+                              callback=lambda result: reactor.callFromThread(d.callback, result),
+                              error_callback=lambda e: reactor.callFromThread(d.errback, failure.Failure(e)))
+        return d
+
+    def process_item(self, item, spider):
+        d = self.slots.run(self.extract, item["compressed_html"])
+        d.addCallback(self.extracted, item)
+        d.addCallback(spider.update_db)
+        d.addCallback(lambda _: item)
+        return d
+
+    @defer.inlineCallbacks
+    def extracted(self, result, item):
+        content, codec, blob, elapsed, tags, tickers, fp, error = result
+        if error is not None:
+            logging.warning("%serror extracting content, url=%s, error=%s%s", Back.RED, item["url"], error, Style.RESET_ALL)
+        else:
+            EXTRACTION_SECONDS.observe(elapsed)
+        item["content"] = content
+        item["tags"] = tags
+        item["symbols"] = sorted(set(item.get("symbols", [])) | set(tickers))
+        page = item.pop("compressed_html")
+        if fp is not None and self.simhash is not None:
+            item["simhash"] = "{0:016x}".format(fp)
+            canonical = yield threads.deferToThread(self.simhash.find, fp, item["uuid"])
+            if canonical is None:
+                item["simhash_ops"] = self.simhash.add_ops(fp, item["uuid"])     # sent once the item is stored
+            else:
+                logging.info("%s is a near duplicate of %s", item["url"], canonical)
+                NEAR_DUPLICATES.inc()
+                item["duplicate_of"] = canonical
+                item["content"] = None
+                defer.returnValue(item)
+        if blob is not None:
+            item["html"] = yield threads.deferToThread(self.store.put, item["uuid"], codec, blob, len(page))
+        defer.returnValue(item)
@@ -0,0 +1,163 @@
+"""
+Resolver for the redirect links of yahoo rss feed items.
+
+Resolved links are kept in an in-process LRU cache with a TTL and in redis
+(redirect:<hash of the link>, expiring after the same TTL) so they are shared
+between processes and nodes and survive restarts. Cache misses are resolved
+concurrently over a shared keep-alive session. The feed updater checks the
+links against the dedup filter first (DedupFilter.seen_link), so an entry
+seen before never costs another http round trip, even once its cache entry
+has expired.
+"""
+import logging
+import threading
+from time import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+import xxhash
+from colorama import Back, Style
+
+REDIRECT_PREFIX = "redirect:"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (iPad; U; CPU OS 4_2_1 like Mac OS X; en-gb) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8C148 Safari/6533.18.5",
+    "From": "http://finance.yahoo.com"
+}
+
+
+def is_redirect(url):
+    """
+    new style yahoo redirect links need a http request to be resolved
+    """
+    return url.startswith("http://finance.yahoo.com/r/")
+
+
+def extract_url(url, session=requests):
+    """
+    extract the real url from yahoo rss feed item
+    """
+    _url = None
+    if '*' in url:                                          # old style yahoo redirect link
+        _url = "http" + url.split("*http")[-1]
+    elif is_redirect(url):                                  # new style yahoo redirect link
+        res = session.get(url, headers=HEADERS)
+        if res.status_code == 200:
+            page_source = res.text
+            if page_source.startswith("<script src="):      # yahoo now uses javascript to make page redirection
+                _url = page_source.split("URL=\'")[-1].split("\'")[0]
+            else:                                           # http redirects were followed by requests
+                _url = res.url
+        else:
+            logging.warning("%sabnormal http status code [%s] url=%s%s", Back.RED, res.status_code, url, Style.RESET_ALL)
+    else:
+        _url = url
+    # if _url is not None:
+    #     if "=yahoo" in _url:                                    # ignore redirect tracking parameters
+    #         _url = "{0}://{1}{2}".format(*urlparse.urlparse(_url))
+    return _url
+
+
+def redirect_key(link):
+    if not isinstance(link, bytes):
+        link = link.encode("utf-8")
+    return REDIRECT_PREFIX + xxhash.xxh64(link).hexdigest()
+
+
+class RedirectResolver(object):
+    """
+    rc is the redis connection holding the shared cache, None to only cache in process
+    """
+
+    def __init__(self, rc=None, maxsize=100000, ttl=7*86400, workers=16):
+        self.rc = rc
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.workers = workers
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = None
+
+    def cached(self, link):
+        with self.lock:
+            hit = self.cache.get(link)
+            if hit is None:
+                return None
+            url, expires = hit
+            if expires < time():
+                del self.cache[link]
+                return None
+            self.cache[link] = self.cache.pop(link)    # most recently used goes last
+            return url
+
+    def remember(self, link, url, expires=None):
+        with self.lock:
+            self.cache.pop(link, None)
+            self.cache[link] = (url, expires or time() + self.ttl)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def fetch(self, link):
+        try:
+            return extract_url(link, session=self.session)
+        except requests.RequestException as e:
+            logging.warning("%serror resolving %s: %r%s", Back.RED, link, e, Style.RESET_ALL)
+            return None
+
+    def store(self, links_urls):
+        """
+        cache resolved (link, url) pairs in process and in redis
+        """
+        pipe = self.rc.pipeline(transaction=False) if self.rc is not None else None
+        for link, url in links_urls:
+            self.remember(link, url)
+            if pipe is not None:
+                pipe.set(redirect_key(link), url, ex=self.ttl)
+        if pipe is not None:
+            pipe.execute()
+
+    def lookup(self, links):
+        """
+        resolve links from the caches only, returns {link: url} for the links found
+        """
+        urls = {}
+        misses = []
+        for link in links:
+            if not is_redirect(link):
+                urls[link] = extract_url(link)
+            else:
+                url = self.cached(link)
+                if url is None:
+                    misses.append(link)
+                else:
+                    urls[link] = url
+        misses = list(OrderedDict.fromkeys(misses))
+        if misses and self.rc is not None:
+            for link, url in zip(misses, self.rc.mget([redirect_key(x) for x in misses])):
+                if url is not None:
+                    url = url.decode("utf-8") if isinstance(url, bytes) and not isinstance(url, str) else url
+                    urls[link] = url
+                    self.remember(link, url)
+        return urls
+
+    def resolve(self, link):
+        return self.resolve_many([link])[link]
+
+    def resolve_many(self, links):
+        """
+        resolve a list of links, returns {link: url}, url is None if the link could not be resolved
+        """
+        urls = self.lookup(links)
+        misses = list(OrderedDict.fromkeys(x for x in links if x not in urls))
+        if misses:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(self.workers)
+            resolved = list(zip(misses, self.pool.map(self.fetch, misses)))
+            urls.update(resolved)
+            self.store([(link, url) for link, url in resolved if url is not None])
+        return urls
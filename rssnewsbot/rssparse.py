@@ -0,0 +1,151 @@
+"""
+Fast parser for the rss 2.0 and atom feeds.
+
+Feeds are streamed through lxml iterparse and only what the feed updater
+uses is kept: the link, title and publication time of the entries and the
+update time of the feed, as time.struct_time in UTC like feedparser. Entries
+without a link are dropped. Malformed xml, and feeds in any other format,
+fall back to feedparser, which is only imported then.
+"""
+import re
+import logging
+from io import BytesIO
+from time import gmtime
+from calendar import timegm
+from email.utils import parsedate_tz
+from lxml import etree
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+DC_DATE = "{http://purl.org/dc/elements/1.1/}date"
+ISO_DATE = re.compile(r"(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?)?\s*(Z|[+-]\d\d:?\d\d)?$")
+
+
+class Entry(object):
+    __slots__ = ("link", "title", "published_parsed")
+
+    def __init__(self, link, title=None, published_parsed=None):
+        self.link = link
+        self.title = title
+        self.published_parsed = published_parsed
+
+    def __repr__(self):
+        return "Entry({0!r}, {1!r})".format(self.link, self.title)
+
+
+class Feed(object):
+    __slots__ = ("entries", "updated_parsed")
+
+    def __init__(self, entries, updated_parsed=None):
+        self.entries = entries
+        self.updated_parsed = updated_parsed
+
+
+class UnknownFormat(Exception):
+    pass
+
+
+def parse_rfc822(s):
+    t = parsedate_tz(s.strip()) if s else None
+    if t is None:
+        return None
+    return gmtime(timegm(t[:6] + (0, 1, -1)) - (t[9] or 0))
+
+
+def parse_iso8601(s):
+    m = ISO_DATE.match(s.strip()) if s else None
+    if m is None:
+        return None
+    year, month, day, hour, minute, second, tz = m.groups()
+    offset = 0
+    if tz and tz != "Z":
+        tz = tz.replace(":", "")
+        offset = (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (-1 if tz[0] == "-" else 1)
+    ts = timegm((int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0), 0, 1, -1))
+    return gmtime(ts - offset)
+
+
+def parse_date(s):
+    return parse_rfc822(s) or parse_iso8601(s)
+
+
+def text(elem, tag):
+    value = elem.findtext(tag)
+    return value.strip() if value else None
+
+
+def rss_entry(item):
+    link = text(item, "link")
+    if not link:
+        guid = item.find("guid")
+        if guid is not None and guid.get("isPermaLink", "true") == "true":
+            link = (guid.text or "").strip() or None
+    published = parse_date(item.findtext("pubDate")) or parse_date(item.findtext(DC_DATE))
+    return Entry(link, text(item, "title"), published)
+
+
+def atom_entry(entry):
+    link = None
+    for elem in entry.iterfind(ATOM + "link"):
+        if elem.get("rel", "alternate") == "alternate":
+            link = elem.get("href")
+            break
+    published = parse_iso8601(entry.findtext(ATOM + "published")) or parse_iso8601(entry.findtext(ATOM + "updated"))
+    return Entry(link, text(entry, ATOM + "title"), published)
+
+
+def release(elem):
+    """
+    free a processed element and its already processed siblings
+    """
+    elem.clear()
+    parent = elem.getparent()
+    while elem.getprevious() is not None:
+        del parent[0]
+
+
+def parse_fast(xml):
+    entries = []
+    dates = {}
+    root = None
+    context = etree.iterparse(BytesIO(xml), events=("start", "end"), resolve_entities=False, no_network=True)
+    for event, elem in context:
+        if root is None:
+            root = elem
+            if elem.tag not in ("rss", ATOM + "feed"):
+                raise UnknownFormat(elem.tag)
+        if event == "start":
+            continue
+        tag = elem.tag
+        if tag == "item" or tag == ATOM + "entry":
+            entry = rss_entry(elem) if tag == "item" else atom_entry(elem)
+            if entry.link:
+                entries.append(entry)
+            release(elem)
+        elif tag in ("lastBuildDate", "pubDate", ATOM + "updated"):
+            parent = elem.getparent()
+            if parent is not None and parent.tag in ("channel", ATOM + "feed"):
+                dates[tag] = elem.text
+    if root.tag == "rss":
+        updated = parse_date(dates.get("lastBuildDate")) or parse_date(dates.get("pubDate"))
+    else:
+        updated = parse_iso8601(dates.get(ATOM + "updated"))
+    return Feed(entries, updated)
+
+
+def parse_feedparser(xml):
+    import feedparser as fp
+    rss = fp.parse(xml)
+    entries = [Entry(e.get("link"), e.get("title"), e.get("published_parsed")) for e in rss.entries if e.get("link")]
+    return Feed(entries, rss.feed.get("updated_parsed"))
+
+
+def parse(xml):
+    """
+    parse a feed body, returns a Feed with the Entry records in document order
+    """
+    if isinstance(xml, bytes):
+        try:
+            return parse_fast(xml)
+        except (etree.XMLSyntaxError, UnknownFormat) as e:
+            logging.debug("falling back to feedparser: %r", e)
+    return parse_feedparser(xml)
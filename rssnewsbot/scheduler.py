@@ -0,0 +1,92 @@
+"""
+Adaptive polling scheduler for rss feeds.
+
+Every feed gets its own polling interval estimated from the history of its
+changes (updated_timestamps of the feed document): busy feeds are polled every
+few seconds, dormant ones back off to many minutes. Feeds are kept in a heap
+ordered by next due time and a token bucket caps the total number of fetches
+per second over all feeds.
+"""
+import heapq
+from time import time
+
+
+class FeedScheduler(object):
+    """
+    heap of feed tasks ordered by the time they are next due
+
+    tasks are feed documents (dicts with "tid" and optionally "updated_timestamps"),
+    budget is the max number of fetches per second over all feeds.
+    """
+
+    def __init__(self, tasks, min_interval=5, max_interval=1800, default_interval=60, budget=20.0, window=20):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.budget = float(budget)
+        self.window = window
+        self.tokens = self.budget
+        self.refilled = time()
+        self.tasks = {}
+        self.heap = []
+        now = time()
+        for i, task in enumerate(tasks):
+            self.tasks[task["tid"]] = task
+            # spread the first round over one budget-second per feed instead of a thundering herd
+            heapq.heappush(self.heap, (now + i / self.budget, task["tid"]))
+
+    def __len__(self):
+        return len(self.heap)
+
+    def interval(self, task, now=None):
+        """
+        estimate the polling interval of a feed from its change history:
+        half of the mean gap between recent changes, stretched when the feed
+        has been silent for much longer than that
+        """
+        now = now or time()
+        ts = sorted(task.get("updated_timestamps") or [])[-self.window:]
+        if len(ts) < 2:
+            interval = self.default_interval
+        else:
+            interval = (ts[-1] - ts[0]) / (len(ts) - 1) / 2.0
+        if ts:
+            interval = max(interval, (now - ts[-1]) / 4.0)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def refill(self, now):
+        self.tokens = min(self.budget, self.tokens + (now - self.refilled) * self.budget)
+        self.refilled = now
+
+    def due(self, now=None, accept=None):
+        """
+        pop the tasks that are due and fit into the fetch budget, most overdue first;
+        popped tasks must be handed back with reschedule() once polled.
+        due tasks rejected by accept(task) are skipped without using the budget.
+        """
+        now = now or time()
+        self.refill(now)
+        tasks = []
+        while self.heap and self.heap[0][0] <= now and self.tokens >= 1:
+            _, tid = heapq.heappop(self.heap)
+            if accept is not None and not accept(self.tasks[tid]):
+                heapq.heappush(self.heap, (now + self.default_interval, tid))
+                continue
+            tasks.append(self.tasks[tid])
+            self.tokens -= 1
+        return tasks
+
+    def reschedule(self, task, now=None):
+        now = now or time()
+        heapq.heappush(self.heap, (now + self.interval(task, now), task["tid"]))
+
+    def next_due(self):
+        """
+        seconds until the next task is due (and the budget allows to fetch it)
+        """
+        if not self.heap:
+            return self.default_interval
+        wait = self.heap[0][0] - time()
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.budget)
+        return max(wait, 0)
@@ -42,6 +42,25 @@ REDIS_DUPFLT = {
 
 REDIS_PENDING_QUEUE = 'pending'
 
+# the article spider polls the pending queue this often (seconds) and pops at
+# most this many items at once to fill its free download slots
+QUEUE_POLL_INTERVAL = 0.5
+QUEUE_BATCH_SIZE = 100
+
+# pending items are consumed from a redis stream through a consumer group,
+# unacked items are retried after PENDING_RETRY_BACKOFF * 2 ** (deliveries - 1)
+# seconds and moved to PENDING_DEAD after PENDING_MAX_RETRIES deliveries
+PENDING_STREAM = "pending_stream"
+PENDING_GROUP = "articlespider"
+PENDING_DEAD = "pending_dead"
+PENDING_MAX_RETRIES = 5
+PENDING_RETRY_BACKOFF = 60
+
+# buffered redis/mongodb writes are flushed when this many are pending
+# or when the oldest one has waited this many seconds
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_DELAY = 1.0
+
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'rssnewsbot (+http://www.yourdomain.com)'
 
@@ -82,6 +101,19 @@ ROBOTSTXT_OBEY = True
 # DOWNLOADER_MIDDLEWARES = {
 #     'scrapy.contrib.downloadermiddleware.httpproxy.HttpProxyMiddleware': 1,
 # }
+DOWNLOADER_MIDDLEWARES = {
+    'rssnewsbot.middlewares.DomainFeedbackMiddleware': 950,
+}
+
+# article downloads are spread over per host queues, each host starts at
+# DOMAIN_RATE requests per second and adapts between DOMAIN_MIN_RATE and
+# DOMAIN_MAX_RATE to throttling responses and to its latency; at most
+# DISPATCH_BUFFER pending items are held in the host queues
+DOMAIN_RATE = 1.0
+DOMAIN_MIN_RATE = 0.05
+DOMAIN_MAX_RATE = 8.0
+DOMAIN_TARGET_LATENCY = 2.0
+DISPATCH_BUFFER = 500
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
@@ -91,9 +123,42 @@ ROBOTSTXT_OBEY = True
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'rssnewsbot.pipelines.RssnewsbotPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'rssnewsbot.pipelines.ExtractionPipeline': 300,
+}
+
+# raw pages are compressed and stored out of line, in GridFS ("gridfs") or
+# in files under HTML_STORE_PATH ("file"), see rssnewsbot/blobstore.py
+HTML_STORE = "gridfs"
+HTML_STORE_PATH = "html"
+# zstd dictionary trained on finance news pages
+#HTML_DICT_PATH = "html.dict"
+# older dictionaries, still needed to read the pages compressed with them
+#HTML_OLD_DICT_PATHS = ["html.2017.dict"]
+
+# number of article extraction processes, defaults to the number of cores
+#EXTRACTION_PROCESSES = 4
+# max number of pages waiting for extraction, defaults to CONCURRENT_REQUESTS
+#EXTRACTION_MAX_PENDING = 16
+
+# pickled symbol taggers are cached here, the feed collection is checked for
+# changes every TAGGER_REFRESH seconds, see rssnewsbot/tagger.py
+TAGGER_CACHE = "tagger"
+TAGGER_REFRESH = 300
+
+# articles within NEAR_DUP_DISTANCE bits (simhash) of one stored in the last
+# NEAR_DUP_TTL seconds are linked to it, see rssnewsbot/simhash.py
+NEAR_DUP_DETECTION = True
+NEAR_DUP_DISTANCE = 3
+NEAR_DUP_TTL = 7 * 86400
+
+# Metrics in the prometheus text format on http://<host>:METRICS_PORT/metrics,
+# the pending stream depth/age is read every METRICS_INTERVAL seconds
+#METRICS_PORT = 9410
+METRICS_INTERVAL = 15
+# Profile one in every PROFILE_EVERY extractions, stats in PROFILE_PATH.<pid>
+#PROFILE_EVERY = 1000
+PROFILE_PATH = "extraction.prof"
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
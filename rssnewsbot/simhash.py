@@ -0,0 +1,113 @@
+"""
+Near-duplicate detection of article contents.
+
+The same wire story is published under many urls, so the uuid (hash of the
+url) dedup lets every copy through. Contents are fingerprinted with a 64 bit
+SimHash over their word shingles: copies of a story differing by a few
+words get fingerprints a few bits apart. Fingerprints are indexed in redis
+by 4 bands of 16 bits (simhash:<band>:<value>, sorted sets of "hi:lo:uuid"
+scored by the time they were added), any two fingerprints at most 3 bits
+apart share a band, so the candidates are found with 4 lookups and compared
+server side. Only the members added in the last ttl seconds are compared,
+older ones are removed whenever a fingerprint is added to their band.
+
+find() looks a fingerprint up, add_ops() are the redis commands indexing
+it, sent by the write batcher once the document of the article is inserted
+(WriteBatcher.mongo(..., then=...)), so duplicate_of never points to an
+article that failed to store. The first stored article of a story becomes
+the canonical one and later copies are linked to it.
+"""
+import re
+from time import time
+import xxhash
+
+SIMHASH_PREFIX = "simhash:"
+BANDS = 4
+BAND_BITS = 16
+WORDS = re.compile(r"\w+", re.U)
+
+# KEYS: the band keys of the fingerprint
+# ARGV: hi, lo (the two 32 bit halves of the fingerprint), uuid, max distance, oldest live score
+# returns the uuid of a live fingerprint within the max distance, otherwise false
+FIND = """
+local function distance(a, b)
+    local n = 0
+    while a > 0 or b > 0 do
+        if a % 2 ~= b % 2 then
+            n = n + 1
+        end
+        a, b = math.floor(a / 2), math.floor(b / 2)
+    end
+    return n
+end
+
+local hi, lo, max_distance = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[4])
+for _, key in ipairs(KEYS) do
+    for _, member in ipairs(redis.call('ZRANGEBYSCORE', key, ARGV[5], '+inf')) do
+        local mhi, mlo, uuid = string.match(member, '^(%d+):(%d+):(.+)$')
+        if uuid ~= ARGV[3] and distance(hi, tonumber(mhi)) + distance(lo, tonumber(mlo)) <= max_distance then
+            return uuid
+        end
+    end
+end
+return false
+"""
+
+
+def fingerprint(text, shingle=3, min_words=50):
+    """
+    64 bit simhash of the word shingles of text, None for texts too short to compare
+    """
+    words = WORDS.findall(text.lower()) if text else []
+    if len(words) < min_words:
+        return None
+    weights = [0] * 64
+    for i in range(len(words) - shingle + 1):
+        h = xxhash.xxh64(" ".join(words[i:i + shingle]).encode("utf-8")).intdigest()
+        for bit in range(64):
+            if h >> bit & 1:
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def band_keys(fp, prefix=SIMHASH_PREFIX):
+    mask = (1 << BAND_BITS) - 1
+    return ["{0}{1}:{2:04x}".format(prefix, band, fp >> (band * BAND_BITS) & mask) for band in range(BANDS)]
+
+
+class SimHashIndex(object):
+    def __init__(self, rc, max_distance=3, ttl=7*86400, prefix=SIMHASH_PREFIX):
+        self.rc = rc
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.prefix = prefix
+        self.script = rc.register_script(FIND)
+
+    def find(self, fp, uuid):
+        """
+        uuid of the canonical article fp is a near duplicate of, None if fp is new
+        """
+        canonical = self.script(keys=band_keys(fp, self.prefix),
+                                args=[fp >> 32, fp & 0xffffffff, uuid, self.max_distance, time() - self.ttl])
+        if isinstance(canonical, bytes) and not isinstance(canonical, str):
+            canonical = canonical.decode("utf-8")
+        return canonical or None
+
+    def add_ops(self, fp, uuid):
+        """
+        the redis commands indexing fp for uuid and dropping the expired members of its bands
+        """
+        now = time()
+        member = "{0}:{1}:{2}".format(fp >> 32, fp & 0xffffffff, uuid)
+        ops = []
+        for key in band_keys(fp, self.prefix):
+            ops.append(("zremrangebyscore", (key, "-inf", now - self.ttl)))
+            ops.append(("zadd", (key, {member: now})))
+            ops.append(("expire", (key, self.ttl)))
+        return ops
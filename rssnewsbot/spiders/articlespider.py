@@ -1,90 +1,26 @@
-from time import sleep, gmtime, mktime
-from collections import defaultdict
+from time import time, gmtime, mktime
 from datetime import datetime
-import zlib
-import operator
 import logging
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.internet import defer, threads, task
 import redis
 import msgpack
 import pymongo as pm
+from bson import ObjectId
 from colorama import Back, Fore, Style
-from bs4 import BeautifulSoup, Comment, Doctype, CData, ProcessingInstruction, Declaration, Tag
-from ..settings import MONGODB_URI, REDIS_HOST, REDIS_PORT, REDIS_PWD, PENDING_QUEUE
-
-
-def extract_content(res):
-    page = res.body
-    noisy_elms = [Comment, Doctype, CData, ProcessingInstruction, Declaration]
-    noisy_tags = ["script", "style", "img", "iframe", "select"]
-    text_tags = ['p', "span", "ul", "td"]
-
-    def clean_texttag(soup_texttag):
-        for child in soup_texttag.contents:
-            if isinstance(child, Tag):
-                if "onmouseover" in child.attrs:
-                    child.extract()
-        return soup_texttag
-
-    def remove_empty_tags(soup):
-        if isinstance(soup, Tag):
-            if len(soup.contents) > 0:
-                for child in soup.contents:
-                    if isinstance(child, Tag):
-                        remove_empty_tags(child)
-            if len(soup.contents) == 0:
-                soup.extract()
-        return soup
-
-    def prune(soup):
-        # remove noisy tags
-        for e in soup(noisy_tags):
-            e.extract()
-
-        # remove noisy elements
-        for noisy_elm in noisy_elms:
-            elms = soup.findAll(e=lambda e: isinstance(e, noisy_elm))
-            for e in elms:
-                e.extract()
-
-        # remove <head>
-        soup.head.extract()
-
-        # remove empty tags
-        soup = remove_empty_tags(soup)
-
-        # remove footer
-        try:
-            if soup.footer:
-                soup.footer.extract()
-        except e:
-            pass
-        for div in soup.select("#footer"):
-            div.extract()
-        for div in soup.select(".footer"):
-            div.extract()
-        return soup
-
-    # Get containers that contain text tags,
-    # build two dicts of them:
-    # k: container, v: text
-    # k: container, v: word count
-    soup = prune(BeautifulSoup(page, 'lxml'))
-    target_tags = soup.find_all(text_tags)
-    container_text = defaultdict(lambda: '')
-    container_wcount = defaultdict(int)
-    for text_tag in target_tags:
-        #texttag = self.clean_texttag(texttag)
-        text = text_tag.get_text()
-        wcount = len(text.split())
-        container_text[text_tag.parent] += text_tag.get_text(separator=' ', strip=True) + '\n'
-        container_wcount[text_tag.parent] += wcount
-    if len(container_wcount) > 0:
-        # Select the container that has biggest word count
-        content_container = max(container_wcount.iteritems(), key=operator.itemgetter(1))[0]
-        return container_text[content_container]
-    else:
-        return None
+from ..settings import MONGODB_URI, REDIS_HOST, REDIS_PORT, REDIS_PWD, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, \
+    QUEUE_POLL_INTERVAL, QUEUE_BATCH_SIZE, PENDING_STREAM, PENDING_GROUP, PENDING_DEAD, PENDING_MAX_RETRIES, \
+    PENDING_RETRY_BACKOFF, DOMAIN_RATE, DOMAIN_MIN_RATE, DOMAIN_MAX_RATE, DOMAIN_TARGET_LATENCY, DISPATCH_BUFFER
+from ..batching import WriteBatcher
+from ..storage import NewsStore
+from ..fanout import FanOut, index_map
+from ..pendingqueue import PendingQueue
+from ..dispatcher import DomainDispatcher, THROTTLED
+from .. import metrics
+from ..metrics import PENDING_DEPTH, PENDING_AGE, PUBLISH_TO_STORED_SECONDS, ARTICLES_STORED
 
 
 class ArticleSpider(scrapy.Spider):
@@ -97,44 +33,181 @@ class ArticleSpider(scrapy.Spider):
         else:
             self.rc = redis.Redis()
         self.mc = pm.MongoClient(host=MONGODB_URI)
+        self.store = NewsStore(self.mc.rssnews)
+        self.fanout = FanOut(self.rc, index_map(self.mc.rssnews.feed.find({}, {"symbol": True, "index": True, "indexes": True})))
+        self.batcher = WriteBatcher(self.rc, self.mc, max_size=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY)
+        self.queue = PendingQueue(self.rc, PENDING_STREAM, PENDING_GROUP, dead=PENDING_DEAD,
+                                  max_retries=PENDING_MAX_RETRIES, backoff=PENDING_RETRY_BACKOFF)
+        self.queue.create_group()
+        self.dispatcher = DomainDispatcher(rate=DOMAIN_RATE, min_rate=DOMAIN_MIN_RATE, max_rate=DOMAIN_MAX_RATE,
+                                           target_latency=DOMAIN_TARGET_LATENCY)
+        self.touched = time()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(ArticleSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
 
     def start_requests(self):
-        while True:
-            cmd = self.rc.get("article_spider")
-            if cmd == "start":
-                feed_item = msgpack.unpackb(self.rc.brpop(PENDING_QUEUE, 50)[1])
-                if feed_item is None:
-                    sleep(5)
-                    continue
-                url = feed_item["url"]
-                req = scrapy.Request(url=url, meta={"feed_item": feed_item})
-                req.headers["User-Agent"] = "Mozilla/5.0 (iPad; U; CPU OS 4_2_1 like Mac OS X; en-gb) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8C148 Safari/6533.18.5"
-                yield req
-            elif cmd == "stop":
-                logging.debug("%sarticle spider stopped%s", Fore.RED, Style.RESET_ALL)
-                break
-            else:
-                logging.debug("%swaiting for cmd, set key 'article_spider' to 'start' or 'stop'%s", Fore.GREEN, Style.RESET_ALL)
-                sleep(10)
+        """
+        requests are fed from the pending queue by refill() once the spider is opened
+        """
+        return []
+
+    def spider_opened(self, spider):
+        if self.settings.getint("METRICS_PORT"):
+            metrics.start_http_server(self.settings.getint("METRICS_PORT"))
+        self.refiller = task.LoopingCall(self.refill)
+        self.start_refiller()
+        self.reporter = task.LoopingCall(self.report_queue)
+        self.reporter.start(self.settings.getfloat("METRICS_INTERVAL", 15))
+
+    def start_refiller(self, now=True):
+        self.refiller.start(QUEUE_POLL_INTERVAL, now=now).addErrback(self.refill_failed)
+
+    def refill_failed(self, failure):
+        """
+        an unexpected error stops the LoopingCall, log it and keep refilling
+        """
+        logging.error("%serror refilling the download queue, restarting: %s%s", Back.RED,
+                      failure.getTraceback(), Style.RESET_ALL)
+        if not self.refiller.running:
+            self.start_refiller(now=False)
+
+    def spider_idle(self, spider):
+        raise DontCloseSpider
+
+    def free_slots(self):
+        """
+        number of requests that can be handed to scrapy without queueing in its
+        scheduler, through the public engine api of scrapy 2.19
+        """
+        engine = self.crawler.engine
+        if engine.needs_backout():
+            return 0
+        queued = len(engine.scheduler) if engine.scheduler is not None else 0
+        return self.settings.getint("CONCURRENT_REQUESTS") - len(engine.downloader.active) - queued
+
+    @defer.inlineCallbacks
+    def refill(self):
+        """
+        top up the per host queues of the dispatcher from the pending queue and schedule
+        as many requests as there are free download slots and hosts allowed to send,
+        without blocking the reactor
+        """
+        wanted = min(DISPATCH_BUFFER - len(self.dispatcher), QUEUE_BATCH_SIZE)
+        try:
+            cmd, feed_items = yield threads.deferToThread(self.pop_items, wanted)
+            if time() - self.touched > PENDING_RETRY_BACKOFF / 2.0:
+                self.touched = time()
+                yield threads.deferToThread(self.queue.touch, [x["pending_id"] for x in self.dispatcher.items()])
+        except Exception:
+            logging.exception("error popping pending items")
+            return
+        if cmd == "stop":
+            logging.debug("%sarticle spider stopped%s", Fore.RED, Style.RESET_ALL)
+            self.refiller.stop()
+            self.crawler.engine.close_spider(self, "stopped")
+        elif cmd != "start":
+            logging.debug("%swaiting for cmd, set key 'article_spider' to 'start' or 'stop'%s", Fore.GREEN, Style.RESET_ALL)
+        for feed_item in feed_items:
+            self.dispatcher.add(feed_item["url"], feed_item)
+        free = self.free_slots()
+        if free > 0:
+            for feed_item in self.dispatcher.pop(free):
+                self.crawler.engine.crawl(self.make_request(feed_item))
+
+    @defer.inlineCallbacks
+    def report_queue(self):
+        try:
+            depth, age = yield threads.deferToThread(self.queue.stats)
+        except Exception:
+            logging.exception("error reading pending queue stats")
+            return
+        PENDING_DEPTH.set(depth)
+        PENDING_AGE.set(age)
+
+    def pop_items(self, count):
+        """
+        check the control key and read up to count items from the pending queue,
+        runs in the reactor thread pool
+        """
+        cmd = self.rc.get("article_spider")
+        if isinstance(cmd, bytes):
+            cmd = cmd.decode("utf-8")
+        if cmd != "start" or count <= 0:
+            return cmd, []
+        feed_items = []
+        for entry_id, item in self.queue.pop(count):
+            feed_item = msgpack.unpackb(item)
+            feed_item["pending_id"] = entry_id
+            feed_items.append(feed_item)
+        return cmd, feed_items
+
+    def make_request(self, feed_item):
+        # pending items come back with the url of their failed attempt (reclaimed, throttled),
+        # the duplicate filter of scrapy would drop them
+        req = scrapy.Request(url=feed_item["url"], meta={"feed_item": feed_item}, errback=self.download_failed,
+                             dont_filter=True)
+        req.headers["User-Agent"] = "Mozilla/5.0 (iPad; U; CPU OS 4_2_1 like Mac OS X; en-gb) AppleWebKit/533.17.9 (KHTML, like Gecko) Version/5.0.2 Mobile/8C148 Safari/6533.18.5"
+        return req
+
+    def download_failed(self, failure):
+        """
+        the item stays unacked in the pending queue and is retried after a backoff
+        """
+        feed_item = failure.request.meta["feed_item"]
+        if failure.check(HttpError) and failure.value.response.status in THROTTLED:
+            self.dispatcher.add(feed_item["url"], feed_item)     # retried once the host accepts requests again
+            return
+        logging.warning("%sfail to download %s: %s%s", Back.RED, feed_item["url"], failure.getErrorMessage(), Style.RESET_ALL)
 
     def parse(self, res):
         logging.debug("%sparsing %s%s", Fore.LIGHTBLACK_EX, res.url, Style.RESET_ALL)
         feed_item = res.meta["feed_item"]
         feed_item["published_dt"] = datetime.fromtimestamp(feed_item["published"])
-        self.parse_page(res, feed_item)
+        return self.parse_page(res, feed_item)
 
     def parse_page(self, res, feed_item):
+        """
+        the content is extracted from the raw page by the ExtractionPipeline,
+        which stores the page out of line and then calls update_db
+        """
         feed_item["url"] = res.url
-        feed_item["content"] = extract_content(res) or None
         feed_item["compressed_html"] = res.body
-        self.update_db(feed_item)
+        yield feed_item
 
     def update_db(self, feed_item):
         feed_item["parsed"] = mktime(gmtime())
         feed_item["parsed_dt"] = datetime.fromtimestamp(feed_item["parsed"])
-        _id = self.mc.rssnews.news.insert_one(feed_item)
+        pending_id = feed_item.pop("pending_id", None)
+        _id = feed_item["_id"] = ObjectId()
+        ack = self.queue.ack_ops(pending_id) if pending_id is not None else []
+        then = ack + feed_item.pop("simhash_ops", [])
+        if feed_item["content"] is not None and not feed_item.get("duplicate_of"):
+            then.append(("lpush", ("nlp", str(_id))))
+        self.store.insert(self.batcher, feed_item, then, on_duplicate=ack)     # stored by an earlier delivery
         logging.debug("%sparsed %s, mongodb _id=%s%s", Back.GREEN, feed_item["url"], _id, Style.RESET_ALL)
-        if feed_item["content"] is not None:
-            self.rc.lpush("nlp", str(_id))
-        else:
+        if feed_item.get("published"):
+            PUBLISH_TO_STORED_SECONDS.observe(feed_item["parsed"] - feed_item["published"])
+        stored = dict((k, feed_item.get(k)) for k in ("uuid", "title", "link", "url", "published", "parsed",
+                                                      "symbols", "tags", "duplicate_of"))
+        for symbol in feed_item["symbols"]:
+            self.fanout.stored(symbol, stored)
+        if feed_item.get("duplicate_of"):
+            ARTICLES_STORED.inc(content="duplicate")
+            self.store.add_symbols(self.batcher, feed_item["duplicate_of"], feed_item["symbols"])
+            return
+        ARTICLES_STORED.inc(content="yes" if feed_item["content"] is not None else "no")
+        if feed_item["content"] is None:
             logging.warning("%sfail to extract content, url=%s%s", Back.RED, feed_item["url"], Style.RESET_ALL)
+
+    def closed(self, reason):
+        if self.refiller.running:
+            self.refiller.stop()
+        if self.reporter.running:
+            self.reporter.stop()
+        self.batcher.close()
+        self.fanout.close()
@@ -6,9 +6,11 @@ import redis
 import msgpack
 import xxhash
 import pymongo as pm
-import feedparser as fp
 from colorama import Back, Fore, Style
 from ..settings import MONGODB_URI, REDIS_HOST, REDIS_PORT, REDIS_PWD, REDIS_PENDING_QUEUE
+from ..feedcache import NOT_MODIFIED, request_headers, changed_validators
+from ..resolver import RedirectResolver
+from .. import rssparse
 
 
 def hs(s):
@@ -27,41 +29,77 @@ def time2ts(time_struct):
 
 class RSSSpider(scrapy.Spider):
     name = "rssspider"
+    handle_httpstatus_list = [NOT_MODIFIED]
 
     def __init__(self, *args, **kwargs):
         super(RSSSpider, self).__init__(*args, **kwargs)
         self.rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PWD)
         self.df = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PWD, db=REDIS_DUPFLT_DB)
         self.mc = pm.MongoClient(host=MONGODB_URI, connect=False)
+        self.resolver = RedirectResolver(self.df)
+        self.validators = {}        # feed _id -> [validators to save, entries left, an entry failed]
 
     def start_requests(self):
         with self.mc.rssnews.feed.find() as cursor:
-            logging.info("number of rss feeds = %d", cursor.count())
+            logging.info("number of rss feeds = %d", self.mc.rssnews.feed.count_documents({}))
             for item in cursor:
                 logging.debug("rss=%(url)s", item)
-                yield scrapy.Request(url=item["url"], callback=self.parse, meta=item)
+                yield scrapy.Request(url=item["url"], callback=self.parse, meta=item, headers=request_headers(item))
 
     def parse(self, res):
+        if res.status == NOT_MODIFIED:
+            logging.debug("not modified %s", res.url)
+            return
         logging.debug("%sparsing %s%s", Fore.GREEN, res.url, Style.RESET_ALL)
-        rss = fp.parse(res.body)
+        # the validators are only saved once every entry was handled, as in feed_updater.py,
+        # or a 304 would hide the entries that failed from the next poll
+        _id = res.meta["_id"]
+        changed = changed_validators(res.meta, res.headers.get("ETag"), res.headers.get("Last-Modified"))
+        rss = rssparse.parse(res.body)
         symbol = res.meta["symbol"]
+        urls = self.resolver.lookup([e.link for e in rss.entries])    # links resolved before need no request
+        requests = []
         for e in rss.entries:
             if self.check_exist(e.link):
                 continue
-            if '*' in e.link:
-                url = "http" + e.link.split("*http")[-1]
-                self.append_task(e, url)
-            elif e.link.startswith("http://finance.yahoo.com/r/"):
-                yield scrapy.Request(url=e.link, callback=self.extract_url, meta=e)
+            if e.link in urls:
+                self.append_task(e, urls[e.link])
             else:
-                self.append_task(e, e.link)
+                requests.append(scrapy.Request(url=e.link, callback=self.extract_url, errback=self.extract_failed,
+                                               meta={"link": e.link, "title": e.title, "feed_id": _id}))
+        self.validators[_id] = [changed, len(requests), False]
+        for req in requests:
+            yield req
+        if not requests:
+            self.entry_done(_id)
 
     def extract_url(self, res):
-        if res.body.startswith("<script src="):
-            url = res.body.split("URL=\'")[-1].split("\'")[0]
+        body = res.text
+        if body.startswith("<script src="):
+            url = body.split("URL=\'")[-1].split("\'")[0]
+            self.resolver.store([(res.meta["link"], url)])
             self.append_task(res.meta, url)
+            self.entry_done(res.meta["feed_id"])
         else:
-            pass
+            logging.warning("%sfail to extract url, link=%s%s", Back.RED, res.meta["link"], Style.RESET_ALL)
+            self.entry_done(res.meta["feed_id"], failed=True)
+
+    def extract_failed(self, failure):
+        logging.warning("%sfail to load %s: %s%s", Back.RED, failure.request.url, failure.getErrorMessage(), Style.RESET_ALL)
+        self.entry_done(failure.request.meta["feed_id"], failed=True)
+
+    def entry_done(self, _id, failed=False):
+        """
+        count down the entries of a feed left to handle, its validators are saved
+        after the last one unless one of them failed
+        """
+        state = self.validators[_id]
+        state[1] -= 1
+        state[2] = state[2] or failed
+        if state[1] <= 0:
+            changed, _, failed = self.validators.pop(_id)
+            if changed and not failed:
+                self.mc.rssnews.feed.update_one({"_id": _id}, {"$set": changed})
 
     def check_exist(self, url):
         return self.df.get(url)
@@ -0,0 +1,312 @@
+"""
+Storage of the news documents.
+
+News are split into monthly collections of the rssnews database
+(news_201708, news_201709, ...) by the time their _id was generated, i.e.
+when the article was stored, so every collection and its indexes stay
+bounded. Every bucket gets a unique index on uuid, a (symbols, published)
+index for the latest news of a symbol and an index on the feed entry link.
+Lookups by uuid search the buckets of the last lookup_months months, newest
+first, and then the legacy collection while it exists.
+
+Writes go through a WriteBatcher: insert() and add_symbols() pick the
+buckets, update_feed() caps updated_timestamps of the feed documents to the
+last timestamps_window values. The bucket of a document known by its _id
+(e.g. from the nlp queue) is bucket_of(_id). The "news" collection of older
+versions is moved into the buckets with
+
+    python -m rssnewsbot.storage migrate
+
+and the raw html of old news is deleted, or moved to an archive store
+(recorded as "html.store": "archive"), with
+
+    python -m rssnewsbot.storage expire-html --days 90 [--archive-path /cold/html]
+"""
+import re
+import logging
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+import pymongo as pm
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
+
+BUCKET_PREFIX = "news_"
+BUCKET_NAME = re.compile(r"^news_\d{6}$")
+LEGACY = "news"
+HEADLINE = dict((x, True) for x in ("uuid", "title", "link", "url", "published", "parsed", "symbols", "tags", "duplicate_of"))
+HEADLINE["_id"] = False
+
+
+def bucket_name(when=None):
+    """
+    bucket of the news stored at when (a utc datetime, default now)
+    """
+    return "{0}{1:%Y%m}".format(BUCKET_PREFIX, when or datetime.utcnow())
+
+
+def bucket_of(_id):
+    """
+    bucket of the news document with ObjectId _id
+    """
+    return bucket_name(_id.generation_time.replace(tzinfo=None))
+
+
+def previous_months(months, when=None):
+    """
+    bucket names of the months months up to when, newest first
+    """
+    when = when or datetime.utcnow()
+    year, month = when.year, when.month
+    names = []
+    for _ in range(months):
+        names.append("{0}{1:04d}{2:02d}".format(BUCKET_PREFIX, year, month))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return names
+
+
+class NewsStore(object):
+    def __init__(self, db, lookup_months=3, timestamps_window=200):
+        self.db = db
+        self.lookup_months = lookup_months
+        self.timestamps_window = timestamps_window
+        self.indexed = set()
+        self.legacy = None
+
+    def collection(self, name):
+        if name not in self.indexed:
+            self.ensure_indexes(name)
+        return self.db[name]
+
+    def ensure_indexes(self, name):
+        news = self.db[name]
+        news.create_index("uuid", unique=True)
+        news.create_index([("symbols", pm.ASCENDING), ("published", pm.DESCENDING)])
+        news.create_index("link")
+        self.indexed.add(name)
+
+    def ensure_feed_indexes(self):
+        self.db.feed.create_index("symbol")
+
+    def buckets(self, since=None):
+        """
+        names of the existing buckets, oldest first, the legacy collection first
+        when it still exists; only the buckets from the month of since when given
+        """
+        names = sorted(x for x in self.db.list_collection_names() if BUCKET_NAME.match(x))
+        if since is not None:
+            first = bucket_name(since)
+            return [x for x in names if x >= first]
+        if LEGACY in self.db.list_collection_names():
+            names.insert(0, LEGACY)
+        return names
+
+    def recent(self):
+        return previous_months(self.lookup_months)
+
+    def has_legacy(self):
+        """
+        whether the legacy news collection still exists (not migrated and dropped yet), checked once
+        """
+        if self.legacy is None:
+            self.legacy = LEGACY in self.db.list_collection_names()
+        return self.legacy
+
+    def locate(self, uuid, projection=None):
+        """
+        (collection name, news document) of uuid stored in the last lookup_months
+        months or else in the legacy collection, (None, None) if not found
+        """
+        for name in self.recent():
+            doc = self.collection(name).find_one({"uuid": uuid}, projection)
+            if doc is not None:
+                return name, doc
+        if self.has_legacy():
+            doc = self.db[LEGACY].find_one({"uuid": uuid}, projection)
+            if doc is not None:
+                return LEGACY, doc
+        return None, None
+
+    def find_uuid(self, uuid, projection=None):
+        """
+        the news document of uuid stored in the last lookup_months months or in the legacy collection
+        """
+        return self.locate(uuid, projection)[1]
+
+    def find_link(self, link, projection=None):
+        """
+        the news document of the feed entry link stored in the last lookup_months months
+        """
+        for name in self.recent():
+            doc = self.collection(name).find_one({"link": link}, projection)
+            if doc is not None:
+                return doc
+        return None
+
+    def latest(self, symbol, limit=20, before=None, months=None, projection=HEADLINE):
+        """
+        the last limit news of symbol, published before the epoch before if given, newest first
+        """
+        query = {"symbols": symbol}
+        if before is not None:
+            query["published"] = {"$lt": before}
+        docs = []
+        for name in previous_months(months or self.lookup_months):
+            if len(docs) >= limit:
+                break
+            cursor = self.collection(name).find(query, projection).sort("published", pm.DESCENDING)
+            docs.extend(cursor.limit(limit - len(docs)))
+        return sorted(docs, key=lambda x: x.get("published") or 0, reverse=True)[:limit]
+
+    def iter_since(self, since=None, projection=None, batch_size=1000, legacy=True):
+        """
+        documents whose _id is at least since (an ObjectId) over all buckets, in _id order,
+        preceded by the legacy collection when since is None unless legacy is false
+        """
+        query = {"_id": {"$gte": since}} if since is not None else {}
+        names = self.buckets(since.generation_time if since is not None else None)
+        if not legacy:
+            names = [x for x in names if x != LEGACY]
+        for name in names:
+            with self.db[name].find(query, projection).sort("_id", 1).batch_size(batch_size) as cursor:
+                for doc in cursor:
+                    yield doc
+
+    def iter_legacy(self, projection=None, batch_size=1000):
+        """
+        documents of the legacy collection, none once it is dropped
+        """
+        with self.db[LEGACY].find({}, projection).batch_size(batch_size) as cursor:
+            for doc in cursor:
+                yield doc
+
+    def insert(self, batcher, doc, then=(), on_duplicate=()):
+        """
+        buffer the insertion of a news document with an _id into its bucket,
+        followed by the redis commands then if it succeeds, or on_duplicate if
+        a document of the same uuid is already stored there
+        """
+        name = bucket_of(doc["_id"])
+        self.collection(name)
+        batcher.mongo(self.db.name, name, pm.InsertOne(doc), then, on_duplicate)
+
+    def add_symbols(self, batcher, uuid, symbols, _id=None):
+        """
+        buffer adding symbols to the news document of uuid, in the bucket of its
+        _id; an _id not given is looked up (recent buckets, then the legacy
+        collection), a document not found is not stored yet (still buffered)
+        and so goes to the current bucket
+        """
+        if _id is not None:
+            name = bucket_of(_id)
+        else:
+            name = self.locate(uuid, {"_id": True})[0] or bucket_name()
+        if name != LEGACY:
+            self.collection(name)
+        batcher.mongo(self.db.name, name, pm.UpdateOne({"uuid": uuid}, {"$addToSet": {"symbols": {"$each": list(symbols)}}}))
+
+    def update_feed(self, batcher, collection, _id, update, upsert=False):
+        """
+        buffer an update of a feed (or feed_group) document, keeping the last
+        timestamps_window updated_timestamps
+        """
+        pushed = update.get("$push", {})
+        if "updated_timestamps" in pushed:
+            pushed["updated_timestamps"] = {"$each": [pushed["updated_timestamps"]], "$slice": -self.timestamps_window}
+        batcher.mongo(self.db.name, collection, pm.UpdateOne({"_id": _id}, update, upsert=upsert))
+
+    def migrate(self, batch_size=1000):
+        """
+        copy the legacy news collection into the buckets, returns the number of documents copied
+        """
+        nb_copied, batches = 0, {}
+
+        def flush(name):
+            try:
+                nb = len(self.collection(name).insert_many(batches.pop(name), ordered=False).inserted_ids)
+            except BulkWriteError as e:          # already copied
+                nb = e.details["nInserted"]
+            return nb
+
+        with self.db[LEGACY].find().sort("_id", 1).batch_size(batch_size) as cursor:
+            for doc in cursor:
+                name = bucket_of(doc["_id"])
+                batches.setdefault(name, []).append(doc)
+                if len(batches[name]) >= batch_size:
+                    nb_copied += flush(name)
+        for name in list(batches):
+            nb_copied += flush(name)
+        return nb_copied
+
+    def html_shared(self, doc):
+        """
+        whether a news document other than doc still references the html blob of doc,
+        blobs are keyed by uuid so only the documents of the same uuid are searched
+        """
+        html = doc["html"]
+        query = {"uuid": doc["uuid"], "_id": {"$ne": doc["_id"]}, "html.store": html["store"], "html.ref": html["ref"]}
+        return any(self.db[name].find_one(query, {"_id": True}) is not None for name in self.buckets())
+
+    def expire_html(self, html_store, days, archive=None):
+        """
+        delete the raw html of the news stored more than days days ago, or move
+        it to the archive html store, whose backend must have another name;
+        a blob still referenced by another document (same uuid stored in
+        another bucket) is kept. Returns the number of pages expired
+        """
+        if archive is not None and archive.backend.name == html_store.backend.name:
+            raise ValueError("the archive store must not be named %s like the html store" % archive.backend.name)
+        cutoff = ObjectId.from_datetime(datetime.utcnow().replace(microsecond=0) - timedelta(days=days))
+        nb_expired = 0
+        for name in self.buckets():
+            query = {"_id": {"$lt": cutoff}, "html.store": html_store.backend.name}
+            with self.db[name].find(query, {"uuid": True, "html": True}) as cursor:
+                for doc in cursor:
+                    html = doc["html"]
+                    try:
+                        if archive is not None:
+                            archive.backend.put(html["ref"], html_store.backend.get(html["ref"]))
+                            self.db[name].update_one({"_id": doc["_id"]}, {"$set": {"html.store": archive.backend.name}})
+                        else:
+                            self.db[name].update_one({"_id": doc["_id"]}, {"$unset": {"html": ""}})
+                        if not self.html_shared(doc):
+                            html_store.delete(html)
+                    except Exception:
+                        logging.exception("fail to expire the html of %s in %s", doc["_id"], name)
+                        continue
+                    nb_expired += 1
+        return nb_expired
+
+
+if __name__ == "__main__":
+    from .blobstore import open_store
+    ap = ArgumentParser(description="create the indexes, move the legacy news collection into buckets or expire old html")
+    ap.add_argument("command", choices=["indexes", "migrate", "expire-html"])
+    ap.add_argument("--mongodb-uri", type=str, default="mongodb://localhost:27017")
+    ap.add_argument("--drop", action="store_true", help="drop the legacy news collection once migrated")
+    ap.add_argument("--days", type=int, default=90, help="age of the html to expire")
+    ap.add_argument("--store", choices=["gridfs", "file"], default="gridfs")
+    ap.add_argument("--store-path", type=str, default="html")
+    ap.add_argument("--archive-path", type=str, default=None, help="move expired html to files under this path")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    mc = pm.MongoClient(host=args.mongodb_uri)
+    store = NewsStore(mc.rssnews)
+    if args.command == "indexes":
+        store.ensure_feed_indexes()
+        for name in store.buckets():
+            if name != LEGACY:          # may hold duplicate uuids, left to migrate
+                store.ensure_indexes(name)
+        logging.info("indexed %d news buckets", len(store.indexed))
+    elif args.command == "migrate":
+        nb_copied = store.migrate()
+        logging.info("copied %d news into the buckets", nb_copied)
+        if args.drop:
+            mc.rssnews[LEGACY].drop()
+    elif args.command == "expire-html":
+        archive = open_store("file", path=args.archive_path, name="archive") if args.archive_path else None
+        nb_expired = store.expire_html(open_store(args.store, mc, args.store_path), args.days, archive)
+        logging.info("expired the html of %d news", nb_expired)
+    mc.close()
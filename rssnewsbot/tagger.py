@@ -0,0 +1,184 @@
+"""
+Tagging of articles with the symbols they mention.
+
+One Aho-Corasick automaton over the tickers and company names of all known
+symbols (DJI.txt, NDX.txt, FTSE.txt and the rssnews.feed collection) finds
+every mention in one pass over the text. Tickers are matched as $AAPL,
+(AAPL) or (NASDAQ: AAPL), company names by the curated aliases of
+ALIASES.txt ("Cisco" for Cisco Systems, "Next plc" rather than "Next", which
+starts ordinary sentences). Matches are case sensitive and must be whole
+words; bare tickers are not matched, most of them are ordinary words.
+
+tag() returns the symbols mentioned either way (the "tags" of an article)
+and the ones mentioned by ticker, which are specific enough to add the
+article to the news of the symbol.
+
+pyahocorasick is used when installed, a pure python automaton otherwise.
+Built taggers are pickled to the cache directory under the hash of their
+symbol list, so they are only rebuilt when the list changes and the
+extraction processes load them from there.
+"""
+import os
+import pickle
+import tempfile
+from collections import deque
+import xxhash
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SYMBOL_FILES = [os.path.join(ROOT, x) for x in ("DJI.txt", "NDX.txt", "FTSE.txt")]
+ALIAS_FILE = os.path.join(ROOT, "ALIASES.txt")
+
+_taggers = {}
+
+
+def load_aliases(path=ALIAS_FILE):
+    """
+    symbol -> company name aliases, from lines "symbol<tab>alias|alias"
+    """
+    aliases = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                symbol, names = line.strip().split("\t")
+                aliases[symbol] = [x for x in names.split("|") if x]
+    return aliases
+
+
+def load_pairs(files=SYMBOL_FILES, feed=None, alias_file=ALIAS_FILE):
+    """
+    sorted (symbol, aliases) pairs of the symbols of the symbol lists and the feed
+    collection, a feed document can list its own "aliases"
+    """
+    symbols = set()
+    for fname in files:
+        with open(fname) as f:
+            for line in f:
+                if line.strip():
+                    symbols.add(line.strip().split("\t")[0])
+    aliases = load_aliases(alias_file)
+    if feed is not None:
+        for doc in feed.find({}, {"symbol": True, "aliases": True}):
+            symbols.add(doc["symbol"])
+            if doc.get("aliases"):
+                aliases[doc["symbol"]] = doc["aliases"]
+    return sorted((x, tuple(aliases.get(x, ()))) for x in symbols)
+
+
+def pairs_version(pairs):
+    return xxhash.xxh64(repr(pairs).encode("utf-8")).hexdigest()
+
+
+class Automaton(object):
+    """
+    pure python stand-in for ahocorasick.Automaton
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    def add_word(self, word, value):
+        node = 0
+        for ch in word:
+            if ch not in self.goto[node]:
+                self.goto[node][ch] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = self.goto[node][ch]
+        self.out[node].append(value)
+
+    def make_automaton(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def iter(self, text):
+        node = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for value in out[node]:
+                yield i, value
+
+
+def ticker_patterns(symbol):
+    tickers = [symbol]
+    base = symbol.split(".")[0]
+    if base != symbol and len(base) > 1:
+        tickers.append(base)
+    words = set()
+    for ticker in tickers:
+        words.update(["$" + ticker, "(" + ticker + ")", ":" + ticker + ")", ": " + ticker + ")"])
+    return words
+
+
+class Tagger(object):
+    def __init__(self, pairs):
+        self.automaton = ahocorasick.Automaton() if ahocorasick is not None else Automaton()
+        words = {}
+        for symbol, aliases in pairs:
+            for word in ticker_patterns(symbol):
+                words.setdefault((word, True), set()).add(symbol)
+            for word in aliases:
+                words.setdefault((word, False), set()).add(symbol)
+        for (word, ticker), symbols in words.items():
+            self.automaton.add_word(word, (len(word), tuple(sorted(symbols)), ticker))
+        self.automaton.make_automaton()
+
+    def tag(self, text):
+        """
+        (sorted symbols mentioned in text, sorted symbols mentioned by ticker)
+        """
+        found, tickers = set(), set()
+        if not text:
+            return [], []
+        last = len(text) - 1
+        for end, (length, symbols, ticker) in self.automaton.iter(text):
+            start = end - length + 1
+            # whole words: no letter or digit may continue a pattern starting or ending with one
+            if ((start == 0 or not text[start].isalnum() or not text[start - 1].isalnum()) and
+                    (end == last or not text[end].isalnum() or not text[end + 1].isalnum())):
+                found.update(symbols)
+                if ticker:
+                    tickers.update(symbols)
+        return sorted(found), sorted(tickers)
+
+
+def cached_tagger(pairs, cache_dir):
+    """
+    path of the pickled tagger of pairs in cache_dir, built if not there yet
+    """
+    path = os.path.join(cache_dir, "tagger-{0}.pickle".format(pairs_version(pairs)))
+    if not os.path.exists(path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(Tagger(pairs), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    return path
+
+
+def load(path):
+    """
+    tagger pickled at path, loaded once per process
+    """
+    if path not in _taggers:
+        with open(path, "rb") as f:
+            _taggers[path] = pickle.load(f)
+    return _taggers[path]
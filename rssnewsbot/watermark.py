@@ -0,0 +1,71 @@
+"""
+Watermark of the entries already processed per feed.
+
+Feeds list their entries newest first and most of the entries of a poll were
+already in the previous one. The feed document keeps a "watermark" with the
+newest publication time seen (epoch seconds) and the hashes of the links of
+the most recent entries, newest first. Only the head of the feed, up to the
+first entry of the watermark, goes through url resolution and the dedup
+filter; entries published long before the watermark are skipped too.
+
+Entries whose processing failed are not marked as seen, their link hashes
+are kept in the "retry" list of the watermark instead and they are returned
+again by every poll, wherever they are in the feed, until they succeed or
+drop out of the feed.
+"""
+from calendar import timegm
+import xxhash
+
+RECENT_SIZE = 50
+GRACE = 3600
+
+
+def entry_hash(link):
+    if not isinstance(link, bytes):
+        link = link.encode("utf-8")
+    return xxhash.xxh64(link).hexdigest()
+
+
+def new_entries(feed, entries, grace=GRACE):
+    """
+    the entries not covered by the watermark of feed, in feed order
+    """
+    mark = feed.get("watermark") or {}
+    recent = set(mark.get("recent", []))
+    retry = set(mark.get("retry", []))
+    newest = mark.get("published")
+    head = []
+    seen = False
+    for e in entries:
+        h = entry_hash(e.link)
+        if h in retry:
+            head.append(e)
+            continue
+        seen = seen or h in recent
+        if seen:
+            if not retry:
+                break
+            continue
+        if newest is not None and e.published_parsed is not None and timegm(e.published_parsed) < newest - grace:
+            continue
+        head.append(e)
+    return head
+
+
+def advance(feed, entries, failed=(), size=RECENT_SIZE):
+    """
+    the watermark of feed after processing its entries, None if unchanged;
+    entries whose link is in failed are left out and kept for retry on the next polls
+    """
+    mark = feed.get("watermark") or {}
+    hashes = [entry_hash(e.link) for e in entries if e.link not in failed]
+    retry = [entry_hash(e.link) for e in entries if e.link in failed][:size]
+    current = set(hashes)
+    recent = (hashes + [h for h in mark.get("recent", []) if h not in current])[:size]
+    published = [timegm(e.published_parsed) for e in entries if e.published_parsed is not None and e.link not in failed]
+    if mark.get("published") is not None:
+        published.append(mark["published"])
+    new_mark = {"published": max(published) if published else None, "recent": recent}
+    if retry:
+        new_mark["retry"] = retry
+    return None if new_mark == mark else new_mark
@@ -0,0 +1,98 @@
+"""
+The article spider run by a real scrapy Crawler, with fakeredis and mongomock
+in place of the redis and mongodb servers and a local http server in place
+of the news sites. Every crawl runs in its own process, since the twisted
+reactor cannot be restarted.
+"""
+import threading
+import multiprocessing
+from time import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import msgpack
+
+
+class NewsSite(BaseHTTPRequestHandler):
+    """
+    serves a small page for every path, /throttled/* answers 429 the first time
+    """
+    hits = {}
+
+    def do_GET(self):
+        hits = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.path.startswith("/throttled/") and hits == 1:
+            self.send_response(429)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"<html><body><p>news</p></body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def crawl(paths, results, timeout):
+    import fakeredis
+    import mongomock
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.settings import Settings
+    from rssnewsbot.spiders import articlespider
+    from rssnewsbot.pendingqueue import PendingQueue
+    from rssnewsbot.settings import PENDING_STREAM, PENDING_GROUP
+
+    server = fakeredis.FakeServer()
+    articlespider.redis.Redis = lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+    articlespider.pm.MongoClient = lambda *args, **kwargs: mongomock.MongoClient()
+
+    site = HTTPServer(("127.0.0.1", 0), NewsSite)
+    thread = threading.Thread(target=site.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    rc = fakeredis.FakeRedis(server=server)
+    rc.set("article_spider", "start")
+    queue = PendingQueue(rc, PENDING_STREAM, PENDING_GROUP)
+    queue.create_group()
+    for i, path in enumerate(paths):
+        queue.push(msgpack.packb({"uuid": "%08x" % i, "title": path, "link": path, "published": time(), "symbols": ["AAPL"],
+                                  "url": "http://127.0.0.1:{0}{1}".format(site.server_port, path)}))
+
+    settings = Settings()
+    settings.setmodule("rssnewsbot.settings")
+    settings.update({"ITEM_PIPELINES": {}, "ROBOTSTXT_OBEY": False, "RETRY_ENABLED": False,
+                     "CLOSESPIDER_TIMEOUT": timeout, "LOG_LEVEL": "WARNING", "TELNETCONSOLE_ENABLED": False})
+    process = CrawlerProcess(settings, install_root_handler=False)
+    crawler = process.create_crawler(articlespider.ArticleSpider)
+    process.crawl(crawler)
+    process.start()
+    site.shutdown()
+    results.put((dict(NewsSite.hits), crawler.stats.get_stats()))
+
+
+def run_crawl(paths, timeout=5):
+    """
+    ({path: number of requests}, scrapy stats) of a crawl of the pending items of paths
+    """
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    proc = ctx.Process(target=crawl, args=(paths, results, timeout))
+    proc.start()
+    hits, stats = results.get(timeout=timeout + 30)
+    proc.join()
+    return hits, stats
+
+
+def test_refill_schedules_pending_items():
+    hits, stats = run_crawl(["/a", "/b"])
+    assert hits == {"/a": 1, "/b": 1}
+    assert stats.get("log_count/ERROR", 0) == 0
+
+
+def test_throttled_item_is_fetched_again():
+    hits, stats = run_crawl(["/throttled/a"], timeout=6)
+    assert hits == {"/throttled/a": 2}
+    assert stats.get("dupefilter/filtered", 0) == 0
@@ -0,0 +1,16 @@
+from rssnewsbot.feedgroup import SymbolMatcher
+
+MEMBERS = [{"symbol": "AAPL"}, {"symbol": "MSFT"}, {"symbol": "BRK.B"}]
+ALIASES = {"AAPL": ["Apple"], "MSFT": ["Microsoft"], "BRK.B": ["Berkshire Hathaway"]}
+
+
+def test_match_by_ticker_and_alias():
+    matcher = SymbolMatcher(MEMBERS, ALIASES)
+    assert matcher.match("Apple and $MSFT rally") == ["AAPL", "MSFT"]
+    assert matcher.match("BRK earnings beat") == ["BRK.B"]
+
+
+def test_unmatched_headline_goes_to_every_symbol():
+    matcher = SymbolMatcher(MEMBERS, ALIASES)
+    assert matcher.match("Stocks close higher as the Fed holds rates") == ["AAPL", "MSFT", "BRK.B"]
+    assert matcher.match("") == ["AAPL", "MSFT", "BRK.B"]